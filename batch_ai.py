@@ -0,0 +1,59 @@
+import numpy
+import game_engine
+import pathing
+
+#The eight steps a monster can take plus standing still, in the same order as FlowField.next_step
+#looks at them so both pick the same step
+STEP_X = numpy.repeat(numpy.arange(-1, 2), 3)
+STEP_Y = numpy.tile(numpy.arange(-1, 2), 3)
+
+def plan_moves(board, monsters):
+    """Works out the moves of a list of BasicMonster pieces together, in one NumPy pass over
+    their positions, and returns them as MoveActions. Each monster within 5 cells of the player
+    steps down the flow field as BasicMonster.take_turn would. When several monsters want the
+    same cell the one earliest in the list gets it and the rest wait. Cells are treated as
+    blocked if they were blocked before anyone moved."""
+    if not monsters:
+        return []
+
+    player = board.player
+    xs = numpy.array([monster.x for monster in monsters], dtype=numpy.int_)
+    ys = numpy.array([monster.y for monster in monsters], dtype=numpy.int_)
+
+    dx = player.x - xs
+    dy = player.y - ys
+    chasing = dx ** 2 + dy ** 2 < 25
+
+    flow = board.flow
+    flow.update()
+
+    #The blocking grid for the flow field's window so every neighbour can be looked up
+    origin_x, origin_y = flow.origin
+    width, height = flow.distance.shape
+    blocked = board.blocked_region(origin_x, origin_y, origin_x + width, origin_y + height)
+
+    #Monsters outside the window can't chase, their lookups are kept in range and ignored
+    window_x = numpy.clip(xs - origin_x, 1, width - 2)
+    window_y = numpy.clip(ys - origin_y, 1, height - 2)
+    chasing &= (window_x == xs - origin_x) & (window_y == ys - origin_y)
+
+    #The distance to the player from each of the nine cells around each monster, shape (monsters, 9)
+    cells_x = window_x[:, numpy.newaxis] + STEP_X
+    cells_y = window_y[:, numpy.newaxis] + STEP_Y
+    distances = flow.distance[cells_x, cells_y]
+    distances[blocked[cells_x, cells_y]] = pathing.UNREACHABLE
+
+    best = numpy.argmin(distances, axis=1)
+    best_distance = distances[numpy.arange(len(monsters)), best]
+    moving = chasing & (best_distance < flow.distance[window_x, window_y])
+
+    dest_x = xs + STEP_X[best]
+    dest_y = ys + STEP_Y[best]
+
+    #numpy.unique gives the index of the first monster heading for each cell
+    moving_indexes = numpy.nonzero(moving)[0]
+    dest_keys = dest_x[moving_indexes] * board.height + dest_y[moving_indexes]
+    unique_keys, first = numpy.unique(dest_keys, return_index=True)
+    winners = numpy.sort(moving_indexes[first])
+
+    return [game_engine.MoveAction(monsters[i], int(dest_x[i]), int(dest_y[i])) for i in winners]
@@ -0,0 +1,328 @@
+import argparse
+import json
+import os
+import tempfile
+import resource
+import subprocess
+import sys
+import timeit
+import numpy
+import render
+import spells
+import floor_pool
+import savegame
+from dungeon import Board
+from game_engine import Game, Message
+from headless import MemoryBackend, MemoryConsole, NullBackend, Simulation
+
+#Sizes and depths used for the map generation scenarios
+MAP_SIZES = [(80, 41), (160, 82), (320, 164)]
+#Floor sizes for the draw scenario, all drawn through a VIEW_SIZE camera
+DRAW_SIZES = [(80, 41), (320, 164), (1280, 656)]
+VIEW_SIZE = (80, 41)
+BSP_DEPTHS = [4, 8, 12]
+#Sizes used for the cave generation scenario
+CAVE_SIZES = [(160, 82), (640, 328), (1000, 500)]
+#A floor big enough to be planned in parts, and how deep its BSP tree goes
+PARTS_SIZE = (2048, 2048)
+PARTS_DEPTH = 14
+#Extra monsters added to a floor for the board and turn scenarios
+MONSTER_COUNTS = [0, 50, 200]
+
+TARGET_FUNCTIONS = [spells.zap_target, spells.random_adjacent_target, spells.burst_target, spells.self_target]
+EFFECT_FUNCTIONS = [spells.hurt, spells.freeze, spells.growth]
+
+def summarise(samples):
+    #Latency percentiles in milliseconds
+    samples = numpy.array(samples) * 1000.0
+    return {
+        'count': len(samples),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(numpy.percentile(samples, 50)),
+        'p90_ms': float(numpy.percentile(samples, 90)),
+        'p99_ms': float(numpy.percentile(samples, 99)),
+        'max_ms': float(samples.max()),
+    }
+
+def time_calls(function, repeats):
+    samples = []
+    for i in range(repeats):
+        start = timeit.default_timer()
+        function()
+        samples.append(timeit.default_timer() - start)
+    return samples
+
+def time_fresh_calls(setup, repeats):
+    #Like time_calls but for things that change what they work on, setup is called before
+    #every sample, outside of the timing, and returns the function to time
+    samples = []
+    for i in range(repeats):
+        function = setup()
+        start = timeit.default_timer()
+        function()
+        samples.append(timeit.default_timer() - start)
+    return samples
+
+def peak_memory_kb():
+    #The peak for the whole process so far, it never goes down
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def make_board(width, height, seed, monsters=0):
+    board = Board(width, height, seed)
+    Game(Message(7, width), board)
+    board.generate()
+    populate(board, monsters)
+    return board
+
+def populate(board, count):
+    #Add count orcs on free floor cells
+    free_x, free_y = numpy.nonzero(~board.blocked & (board.map.tile_ids != 0))
+    chosen = board.random.sample(range(len(free_x)), min(count, len(free_x)))
+    for i in sorted(chosen):
+        orc = board.factory.createPiece('orc', int(free_x[i]), int(free_y[i]))
+        board.add_piece(orc)
+        board.game.add_actor(orc)
+
+def bench_map_generate(seed, repeats):
+    results = {}
+    for width, height in MAP_SIZES:
+        for depth in BSP_DEPTHS:
+            board = make_board(width, height, seed)
+            samples = time_calls(lambda: board.map.generate(depth), repeats)
+            results['map_generate/%dx%d/depth%d' % (width, height, depth)] = summarise(samples)
+    return results
+
+def bench_cave_generate(seed, repeats):
+    results = {}
+    for width, height in CAVE_SIZES:
+        board = make_board(width, height, seed)
+        results['cave_generate/%dx%d' % (width, height)] = summarise(time_calls(board.map.generate_caves, repeats))
+    return results
+
+def bench_validate(seed, repeats):
+    #Checking a freshly generated floor, carving it in full and labelling its regions
+    results = {}
+    for width, height in MAP_SIZES:
+        board = make_board(width, height, seed)
+
+        def validate():
+            board.seed_generators(seed)
+            rooms = board.map.generate()
+            board.map.validate(rooms)
+
+        def generate():
+            board.seed_generators(seed)
+            board.map.generate()
+
+        results['validate/%dx%d' % (width, height)] = summarise(time_calls(validate, repeats))
+        results['validate/%dx%d/generate_only' % (width, height)] = summarise(time_calls(generate, repeats))
+    return results
+
+def bench_parts(seed, repeats):
+    #Planning a huge floor in parts one after another and spread over a FloorGenerator's processes
+    results = {}
+    width, height = PARTS_SIZE
+    board = Board(width, height, seed)
+    name = 'parts/%dx%d/depth%d' % (width, height, PARTS_DEPTH)
+    results[name + '/serial'] = summarise(time_calls(lambda: board.map.generate(PARTS_DEPTH), repeats))
+
+    floor_generator = floor_pool.FloorGenerator()
+    try:
+        board.floor_generator = floor_generator
+        results[name + '/parallel'] = summarise(time_calls(lambda: board.map.generate(PARTS_DEPTH), repeats))
+    finally:
+        floor_generator.close()
+    return results
+
+def bench_board_generate(seed, repeats):
+    results = {}
+    width, height = MAP_SIZES[1]
+    for monsters in MONSTER_COUNTS:
+        board = make_board(width, height, seed)
+
+        def generate():
+            board.seed(seed)
+            board.generate()
+            populate(board, monsters)
+
+        results['board_generate/%dx%d/monsters%d' % (width, height, monsters)] = summarise(time_calls(generate, repeats))
+    return results
+
+def bench_descend(seed, repeats):
+    #Going down the stairs with the floor generated in place and ahead of time
+    results = {}
+    width, height = MAP_SIZES[-1]
+    board = make_board(width, height, seed)
+    results['descend/in_place/%dx%d' % (width, height)] = summarise(time_calls(board.generate, repeats))
+
+    floor_generator = floor_pool.FloorGenerator()
+    try:
+        board = make_board(width, height, seed)
+        board.floor_generator = floor_generator
+        board.generate()
+
+        samples = []
+        for i in range(repeats):
+            #Give the worker time to finish, as playing the floor would
+            floor_generator.pending.values()[0].wait()
+            samples.extend(time_calls(board.generate, 1))
+        results['descend/pregenerated/%dx%d' % (width, height)] = summarise(samples)
+    finally:
+        floor_generator.close()
+    return results
+
+def bench_save(seed, repeats):
+    #Saving and loading a game that has been played for a while on every map size
+    results = {}
+    handle, path = tempfile.mkstemp(suffix='.sav')
+    os.close(handle)
+    try:
+        for width, height in MAP_SIZES:
+            simulation = Simulation(seed, width, height, backend=NullBackend())
+            populate(simulation.board, 50)
+            simulation.run(['zap', 'cast', 'wait'] * 10)
+
+            results['save/%dx%d' % (width, height)] = summarise(time_calls(lambda: simulation.save(path), repeats))
+            results['load/%dx%d' % (width, height)] = summarise(time_calls(lambda: savegame.load(path), repeats))
+            results['load/%dx%d' % (width, height)]['file_kb'] = os.path.getsize(path) / 1024.0
+    finally:
+        os.remove(path)
+    return results
+
+def bench_turns(seed, repeats):
+    #Steady state, the player waits and everything else takes its turns
+    results = {}
+    width, height = MAP_SIZES[1]
+    for batch_ai in (False, True):
+        for monsters in MONSTER_COUNTS:
+            simulation = Simulation(seed, width, height, batch_ai=batch_ai, backend=NullBackend())
+            populate(simulation.board, monsters)
+            samples = time_calls(lambda: simulation.step('wait'), repeats)
+
+            name = 'process_turns/%s/monsters%d' % ('batch' if batch_ai else 'single', monsters)
+            results[name] = summarise(samples)
+            results[name]['steps_per_second'] = len(samples) / sum(samples)
+    return results
+
+def bench_draw(seed, repeats):
+    results = {}
+    render.set_backend(MemoryBackend())
+    for width, height in DRAW_SIZES:
+        board = make_board(width, height, seed, monsters=50)
+        board.renderer.camera.resize(*VIEW_SIZE)
+        console = MemoryConsole(*VIEW_SIZE)
+
+        def full_redraw():
+            board.map.redraw_all = True
+            board.fov.needs_recompute = True
+            board.draw(console)
+
+        results['draw/full/%dx%d' % (width, height)] = summarise(time_calls(full_redraw, repeats))
+        results['draw/steady/%dx%d' % (width, height)] = summarise(time_calls(lambda: board.draw(console), repeats))
+    return results
+
+def bench_spells(seed, repeats):
+    #Every cast gets a fresh board, casting again on the same one would mostly find its
+    #targets already dead, frozen or walled in
+    results = {}
+    width, height = MAP_SIZES[0]
+    for target_function in TARGET_FUNCTIONS:
+        for effect_function in EFFECT_FUNCTIONS:
+            def setup():
+                board = make_board(width, height, seed, monsters=20)
+                return spells.Spell(board.player, target_function, effect_function, max_range=5).cast
+
+            name = 'spell/%s/%s' % (target_function.__name__, effect_function.__name__)
+            results[name] = summarise(time_fresh_calls(setup, repeats))
+    return results
+
+SCENARIOS = [
+    ('map_generate', bench_map_generate),
+    ('cave_generate', bench_cave_generate),
+    ('parts', bench_parts),
+    ('validate', bench_validate),
+    ('board_generate', bench_board_generate),
+    ('descend', bench_descend),
+    ('save', bench_save),
+    ('process_turns', bench_turns),
+    ('draw', bench_draw),
+    ('spell', bench_spells),
+]
+
+def run_scenario(name, seed, repeats):
+    #Run one scenario in this process and give each of its results the process' peak memory,
+    #only meaningful in a process that hasn't run anything else
+    scenario_results = dict(SCENARIOS)[name](seed, repeats)
+    peak = peak_memory_kb()
+    for result in scenario_results.values():
+        result['peak_memory_kb'] = peak
+    return scenario_results
+
+def run(seed=0, repeats=20, only=None):
+    #Each scenario runs in a process of its own so the peak memory is its own and not
+    #whatever the biggest scenario before it reached
+    results = {}
+    for name, scenario in SCENARIOS:
+        if only and name not in only:
+            continue
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--scenario', name,
+                                          '--seed', str(seed), '--repeats', str(repeats)])
+        results.update(json.loads(output.splitlines()[-1]))
+    return results
+
+def compare(results, baseline, threshold):
+    #Returns (name, baseline p50, current p50) for each result that got more than threshold slower
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50_ms']
+        after = results[name]['p50_ms']
+        if before > 0 and (after - before) / before > threshold:
+            regressions.append((name, before, after))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark generation, simulation, drawing and spells.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--only', action='append', choices=[name for name, scenario in SCENARIOS],
+                        help="only run this scenario, can be given more than once")
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="fraction a median can grow by before it counts as a regression")
+    #Used by run to measure a single scenario in a fresh process
+    parser.add_argument('--scenario', choices=[name for name, scenario in SCENARIOS], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.scenario:
+        print(json.dumps(run_scenario(args.scenario, args.seed, args.repeats)))
+        return 0
+
+    results = run(args.seed, args.repeats, args.only)
+
+    for name in sorted(results):
+        result = results[name]
+        print('%-50s p50 %9.3fms  p90 %9.3fms  p99 %9.3fms  max %9.3fms' % (
+            name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['max_ms']))
+    if results:
+        print('peak memory %dKB' % max(result['peak_memory_kb'] for result in results.values()))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'seed': args.seed, 'repeats': args.repeats, 'results': results}, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION %s: %.3fms -> %.3fms' % (name, before, after))
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import spells
+from game_engine import MoveAction, WaitAction
+
+#The direction each movement command moves the player in
+MOVES = {
+    'up': (0, -1),
+    'down': (0, 1),
+    'left': (-1, 0),
+    'right': (1, 0),
+    'up_left': (-1, -1),
+    'up_right': (1, -1),
+    'down_left': (-1, 1),
+    'down_right': (1, 1),
+}
+
+COMMANDS = sorted(MOVES.keys()) + ['wait', 'descend', 'ascend', 'zap', 'cast']
+
+def perform(board, command, current_spell):
+    """Carries out one of the player's commands, whether it came from a key press or a script.
+    Returns False if the command couldn't be carried out."""
+    player = board.player
+
+    if board.game.game_state != "playing":
+        return False
+
+    if command in MOVES:
+        dx, dy = MOVES[command]
+        player.ai.set_action(MoveAction(player, player.x + dx, player.y + dy))
+    elif command == 'wait':
+        #Wait in one place
+        player.ai.set_action(WaitAction(player))
+    elif command == 'descend':
+        if board.map.kind_at(player.x, player.y) != 'down_stairs':
+            return False
+        board.change_floor(board.depth + 1)
+    elif command == 'ascend':
+        if board.map.kind_at(player.x, player.y) != 'up_stairs':
+            return False
+        board.change_floor(board.depth - 1)
+    elif command == 'zap':
+        zap = spells.Spell(board.player, spells.burst_target, spells.freeze, max_range=5)
+        zap.cast()
+    elif command == 'cast':
+        current_spell.cast()
+        current_spell.target_function = spells.random_target(board.random)
+        current_spell.effect_function = spells.random_effect(board.random)
+    else:
+        return False
+
+    return True
@@ -2,205 +2,1010 @@ import libtcodpy as libtcod
 from itertools import cycle
 from game_engine import *
 import game_piece
+import render
+import fov
+import pathing
+import floor_cache
 import random
-from scipy.sparse import csr_matrix
+import numpy
+from scipy.sparse import coo_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import Delaunay, cKDTree
+from scipy.spatial.qhull import QhullError
+from scipy.ndimage import binary_dilation, convolve, label
+
+from game_piece import TILE_KINDS, EMPTY, FLOOR, WALL, DOWN_STAIRS, UP_STAIRS
+
+#How many times the BSP tree is split when generating a floor
+BSP_DEPTH = 8
+#Floors with at least PART_CELLS cells have the top PART_LEVELS levels of their BSP tree split
+#first, and the rooms and corridors inside each part are planned separately, in parallel when
+#the board has a FloorGenerator
+PART_CELLS = 1 << 20
+PART_LEVELS = 4
+#Floors with up to this many cells are carved in full after generating and checked that the
+#stairs can be reached, bigger ones are checked by following their plan and are left to be
+#carved as the player gets to them
+VALIDATE_CELLS = 1 << 18
+#The chance of each corridor left out of the minimum spanning tree being carved anyway to make a loop
+EXTRA_LOOPS = 0.0
+#How many of its nearest rooms each room may be connected to when the rooms can't be triangulated
+ROOM_NEIGHBOURS = 8
+#Floors are carved in CHUNK_SIZE x CHUNK_SIZE chunks as the player comes near them, everything
+#within CARVE_RADIUS chunks of the chunk the player is in is carved
+CHUNK_SIZE = 32
+CARVE_RADIUS = 1
+#The chance of a BSP leaf big enough for one of the VAULTS getting it instead of a plain room
+VAULT_CHANCE = 0.1
+#The chance of a floor being caves instead of rooms and corridors
+CAVE_CHANCE = 0.2
+#Caves start with this fraction of cells as wall and are smoothed CAVE_STEPS times, each time a
+#cell becomes wall if at least 5 of the 9 cells around it, itself included, are wall
+CAVE_FILL = 0.45
+CAVE_STEPS = 5
+#Open cells in a cave for each orc
+CAVE_CELLS_PER_ORC = 150
+#The kinds of row in a Map's plan
+ROOM = 0
+CORRIDOR = 1
+VAULT = 2
+
+#Prefab rooms stamped in place of a plain room, '#' is wall, '.' is floor and anything else is
+#left as it was. The middle cell must be floor since the player, stairs and corridors all start
+#from the center of a room.
+VAULTS = [
+    ['###########',
+     '#.........#',
+     '#.#.#.#.#.#',
+     '#.........#',
+     '#.........#',
+     '#.........#',
+     '#.#.#.#.#.#',
+     '#.........#',
+     '###########'],
+    ['   #####   ',
+     '   #...#   ',
+     '   #...#   ',
+     '####...####',
+     '#.........#',
+     '#.........#',
+     '#.........#',
+     '####...####',
+     '   #...#   ',
+     '   #...#   ',
+     '   #####   '],
+    ['#############',
+     '#...........#',
+     '#.#########.#',
+     '#.#.......#.#',
+     '#.#.......#.#',
+     '#.#.......#.#',
+     '#.####.####.#',
+     '#...........#',
+     '#############'],
+]
+
+def vault_tiles(rows):
+    #A VAULTS template as tile ids and a mask of the cells it sets, both indexed [x, y] like the Map
+    chars = numpy.array([list(row) for row in rows]).T
+    tile_ids = numpy.where(chars == '#', WALL, FLOOR).astype(numpy.uint8)
+    return tile_ids, (chars == '#') | (chars == '.')
+
+VAULT_TILES = [vault_tiles(rows) for rows in VAULTS]
+#The cells of each of the VAULTS that are floor
+VAULT_FLOORS = [mask & (tile_ids == FLOOR) for tile_ids, mask in VAULT_TILES]
+#The cells around a corridor that get walls
+WALL_PADDING = numpy.ones((3, 3), dtype=bool)
 
 class Room:
-    """The representation of a room for use in dungeon genration"""
-    def __init__(self, x, y, width, height):
+    """The representation of a room for use in dungeon genration, vault is the index of its
+    template in VAULTS or None for a plain room"""
+    def __init__(self, x, y, width, height, vault=None):
         self.x = x
         self.y = y
         self.width = width
         self.height = height
+        self.vault = vault
         self.center_x = x + width / 2
         self.center_y = y + height / 2
 
     def distance_to(self, other):
         return abs(self.center_x - other.center_x) + abs(self.center_y - other.center_y)
 
+def room_graph(rooms):
+    """The corridors that could be carved between rooms, as a sparse upper triangular matrix of
+    the distances between their centers. Only neighbouring rooms in the Delaunay triangulation
+    of the centers are candidates, which still includes every corridor a minimum spanning tree
+    needs while keeping the number of candidates in proportion to the number of rooms."""
+    count = len(rooms)
+    centers = numpy.array([(room.center_x, room.center_y) for room in rooms], dtype=numpy.float64).reshape(-1, 2)
+
+    if count < 2:
+        return coo_matrix((count, count)).tocsr()
+    elif count < 4:
+        #Too few to triangulate, so every pair is a candidate
+        starts, ends = numpy.triu_indices(count, 1)
+    else:
+        try:
+            indptr, indices = Delaunay(centers).vertex_neighbor_vertices
+            starts = numpy.repeat(numpy.arange(count), numpy.diff(indptr))
+            ends = indices
+        except QhullError:
+            #All the centers are in a line, connect each to its nearest rooms instead
+            neighbours = min(ROOM_NEIGHBOURS + 1, count)
+            ends = cKDTree(centers).query(centers, k=neighbours, p=1)[1].ravel()
+            starts = numpy.repeat(numpy.arange(count), neighbours)
+
+    #Each pair once, lowest index first
+    pairs = numpy.unique(numpy.sort(numpy.column_stack((starts, ends)), axis=1), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    distances = numpy.abs(centers[pairs[:, 0]] - centers[pairs[:, 1]]).sum(axis=1)
+    return coo_matrix((distances, (pairs[:, 0], pairs[:, 1])), shape=(count, count)).tocsr()
+
+def room_step(room):
+    #A ROOM or VAULT row for a Map's plan, its corners inclusive
+    if room.vault is None:
+        return (ROOM, room.x, room.y, room.x + room.width - 1, room.y + room.height - 1, 0)
+    return (VAULT, room.x, room.y, room.x + room.width - 1, room.y + room.height - 1, room.vault)
+
+def corridor_step(start_x, start_y, end_x, end_y):
+    #A CORRIDOR row for a Map's plan with its ends put in order
+    return (CORRIDOR, min(start_x, end_x), min(start_y, end_y), max(start_x, end_x), max(start_y, end_y), 0)
+
+def connect_rooms(room1, room2):
+    #The plan rows for an L shaped corridor between the centers of two rooms
+    return [corridor_step(room1.center_x, room1.center_y, room2.center_x, room1.center_y),
+            corridor_step(room2.center_x, room1.center_y, room2.center_x, room2.center_y)]
+
+def step_floor(step):
+    #The corners (inclusive) of the cells a plan row opens up, rooms and vaults have walls all round
+    kind, start_x, start_y, end_x, end_y, vault = step
+    if kind == CORRIDOR:
+        return start_x, start_y, end_x, end_y
+    return start_x + 1, start_y + 1, end_x - 1, end_y - 1
+
+def steps_touch(step1, step2):
+    #Whether the cells two plan rows open up are next to each other, diagonals included.
+    #Only the floor of a vault counts, not the walls inside it.
+    min_x1, min_y1, max_x1, max_y1 = step_floor(step1)
+    min_x2, min_y2, max_x2, max_y2 = step_floor(step2)
+    if min_x1 > max_x2 + 1 or min_x2 > max_x1 + 1 or min_y1 > max_y2 + 1 or min_y2 > max_y1 + 1:
+        return False
+
+    for vault_step, other in ((step1, step2), (step2, step1)):
+        if vault_step[0] == VAULT:
+            kind, start_x, start_y, end_x, end_y, vault = vault_step
+            min_x, min_y, max_x, max_y = step_floor(other)
+            near = (clipped(min_x - 1, max_x + 1, start_x, end_x + 1), clipped(min_y - 1, max_y + 1, start_y, end_y + 1))
+            if not VAULT_FLOORS[vault][near].any():
+                return False
+    return True
+
+def touching(part1, part2):
+    #Whether two (x, y, width, height) parts of a floor share some of an edge
+    x1, y1, width1, height1 = part1
+    x2, y2, width2, height2 = part2
+    if x1 + width1 == x2 or x2 + width2 == x1:
+        return y1 < y2 + height2 and y2 < y1 + height1
+    if y1 + height1 == y2 or y2 + height2 == y1:
+        return x1 < x2 + width2 and x2 < x1 + width1
+    return False
+
+def clipped(start, end, low, high):
+    #The slice of an array covering low to high (exclusive) that holds start to end (inclusive),
+    #empty if they don't overlap
+    return slice(min(max(start, low), high) - low, min(max(end + 1, low), high) - low)
+
+class Floor(object):
+    """A generated floor packed up small enough to send between processes, the Map's plan
+    of rooms and corridors and the rooms as (x, y, width, height) rows. Caves have no plan so
+    their tile ids are sent instead. Region labels are left behind, they'd be most of the
+    pickle and the Map labels itself again when something asks. The seed it was generated from
+    is kept so it can be matched up with the floor it's for."""
+    def __init__(self, seed, tile_map, rooms):
+        self.seed = seed
+        self.plan = tile_map.plan
+        self.tile_ids = None
+        if not len(tile_map.plan):
+            self.tile_ids = tile_map.tile_ids
+        self.rooms = numpy.array([(room.x, room.y, room.width, room.height) for room in rooms], dtype=numpy.int32)
+
+    def unpack_rooms(self):
+        return [Room(*room) for room in self.rooms.tolist()]
+
+def generate_floor(width, height, seed, depth=BSP_DEPTH):
+    #Generate a floor on a Board of its own and pack it up, this is what runs in the
+    #FloorGenerator's worker processes
+    board = Board(width, height, seed)
+    rooms = board.map.generate_any(depth)
+    return Floor(seed, board.map, rooms)
+
+def plan_part(arguments):
+    #Plan the rooms and corridors inside one part of a floor on a Board of its own, this is what
+    #runs in the FloorGenerator's worker processes when a floor is planned in parts
+    x, y, width, height, seed, depth, extra_loops, vault_chance = arguments
+    board = Board(width, height, seed)
+    return board.map.plan_rooms(x, y, width, height, depth, extra_loops, vault_chance)
+
+class TileGrid(object):
+    """A read only view of the Map's tile arrays that can be indexed like a list of lists,
+    map.tiles[x][y] returns the Piece for that cell."""
+    def __init__(self, tile_map):
+        self.map = tile_map
+
+    def __getitem__(self, x):
+        return TileColumn(self.map, x)
+
+    def __len__(self):
+        return self.map.width
+
+class TileColumn(object):
+    """One column of a TileGrid"""
+    def __init__(self, tile_map, x):
+        self.map = tile_map
+        self.x = x
+
+    def __getitem__(self, y):
+        return self.map.tile_at(self.x, y)
+
+    def __len__(self):
+        return self.map.height
+
 class Map:
-    """The Map represents the floor and walls of the dungeon."""
+    """The Map represents the floor and walls of the dungeon.
+    Each cell is stored as a tile id in a NumPy array alongside blocks_passage and blocks_light
+    flag arrays, all cells of a kind share the factory's TileType for it. A Tile is only made
+    for a cell when something asks for it with tile_at, and only kept once it's been changed.
+    Generating a floor only plans its rooms and corridors, each chunk of the floor is carved
+    from the plan the first time the player comes near it or something looks at one of its
+    cells. Until then its cells are empty and block passage and light."""
     def __init__(self, board, width, height):
         self.width = width
         self.height = height
         self.board = board
-        self.tiles = [[self.board.factory.createPiece('empty', x, y) for y in range(self.height)] for x in range(self.width)]
 
-    def draw(self, console):
-        #The Map draws all of the tiles.
-        libtcod.console_set_default_foreground(console, libtcod.white)
-
-        for y in range(self.height):
-            row = ''
-            for x in range(self.width):
-                char = self.tiles[x][y].sprite.char
-                color = self.tiles[x][y].sprite.color
-                rgb = (color.r, color.g, color.b)
-                row += ('%c%c%c%c%c%c%c%c%c%c' % ((libtcod.COLCTRL_FORE_RGB, ) + rgb + (libtcod.COLCTRL_BACK_RGB, ) + (1,1,1) + (char, libtcod.COLCTRL_STOP)))
-            libtcod.console_print(console, 0, y, row)
-
-    def carve_room(self, start_x, start_y, width, height):
-        end_x = start_x + width - 1
-        end_y = start_y + height - 1
-        for y in range(start_y, end_y + 1):
-            for x in range(start_x, end_x + 1):
-                if x == start_x or y == start_y or x == end_x or y == end_y:
-                    self.tiles[x][y] = self.board.factory.createPiece('wall', x, y)
-                else:
-                    self.tiles[x][y] = self.board.factory.createPiece('floor', x, y)
-
-    def carve_corridor_rooms(self, left_room, right_room, horizontal):
-        if horizontal:
-            left_max_x = left_room.x + left_room.width
-            right_max_x = right_room.x + right_room.width
-            min_x = max(left_room.x, right_room.x)
-            max_x = min(left_max_x, right_max_x)
-            x = random.randint(min_x + 1, max_x - 2)
-            for y in range(left_room.y + left_room.height - 1, left_room.y - 1, -1):
-                if not self.tiles[x][y].blocks_passage:
-                    start_y = y
-                    break
-            for y in range(right_room.y, right_room.y + right_room.height - 1):
-                if not self.tiles[x][y].blocks_passage:
-                    end_y = y
-                    break
-            self.carve_corridor(x, start_y, x, end_y)
+        self.tile_types = self.board.factory.tile_types
+        self.kind_blocks_passage = numpy.array([tile_type.blocks_passage for tile_type in self.tile_types], dtype=bool)
+        self.kind_blocks_light = numpy.array([tile_type.blocks_light for tile_type in self.tile_types], dtype=bool)
+
+        self.tiles = TileGrid(self)
+        self.chunks_x = -(-width // CHUNK_SIZE)
+        self.chunks_y = -(-height // CHUNK_SIZE)
+        #Bumped whenever a cell's flags change, so systems built from the map know to rebuild
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        #Fill the whole map with empty tiles, with nothing planned so every chunk counts as carved
+        self.tile_ids = numpy.zeros((self.width, self.height), dtype=numpy.uint8)
+        self.blocks_passage = self.kind_blocks_passage[self.tile_ids]
+        self.blocks_light = self.kind_blocks_light[self.tile_ids]
+        #(kind, start_x, start_y, end_x, end_y, vault) rows carved in order, see room_step and corridor_step
+        self.plan = numpy.zeros((0, 6), dtype=numpy.int32)
+        #The rows of the plan that reach into each chunk, keyed by (chunk_x, chunk_y)
+        self.chunk_plan = {}
+        self.carved = numpy.ones((self.chunks_x, self.chunks_y), dtype=bool)
+        #Connected regions of cells that can be walked on, see label_regions. None until the
+        #floor's been labelled and again whenever a cell's blocks_passage changes
+        self.regions = None
+        self.region_count = 0
+        #Tiles that have been changed and no longer share their TileType
+        self.tile_pieces = {}
+        #Cells the Renderer needs to redraw, redraw_all means the whole map does
+        self.dirty = set()
+        self.redraw_all = True
+        self.version += 1
+
+    def load(self, floor):
+        #Swap in a floor made by generate_floor, returns its rooms
+        self.clear()
+        if floor.tile_ids is None:
+            self.set_plan(floor.plan)
         else:
-            left_max_y = left_room.y + left_room.height
-            right_max_y = right_room.y + right_room.height
-            min_y = max(left_room.y, right_room.y)
-            max_y = min(left_max_y, right_max_y)
-            y = random.randint(min_y + 1, max_y - 2)
-            for x in range(left_room.x + left_room.width - 1, left_room.x - 1, -1):
-                if not self.tiles[x][y].blocks_passage:
-                    start_x = x
-                    break
-            for x in range(right_room.x, right_room.x + right_room.width - 1):
-                if not self.tiles[x][y].blocks_passage:
-                    end_x = x
-                    break
-            self.carve_corridor(start_x, y, end_x, y)
-
-    def carve_corridor(self, start_x, start_y, end_x, end_y):
-        if end_x < start_x:
-            temp = start_x
-            start_x = end_x
-            end_x = temp
-        if end_y < start_y:
-            temp = start_y
-            start_y = end_y
-            end_y = temp
-
-        for x in range(start_x, end_x + 1):
-            self.tiles[x][end_y] = self.board.factory.createPiece('floor', x, end_y)
-            if self.tiles[x][end_y + 1].sprite.char == ' ':
-                self.tiles[x][end_y + 1] = self.board.factory.createPiece('wall', x, end_y + 1)
-            if self.tiles[x][end_y - 1].sprite.char == ' ':
-                self.tiles[x][end_y - 1] = self.board.factory.createPiece('wall', x, end_y - 1)
-
-        for y in range(start_y, end_y + 1):
-            self.tiles[end_x][y] = self.board.factory.createPiece('floor', end_x, y)
-            if self.tiles[end_x + 1][y].sprite.char == ' ':
-                self.tiles[end_x + 1][y] = self.board.factory.createPiece('wall', end_x + 1, y)
-            if self.tiles[end_x - 1][y].sprite.char == ' ':
-                self.tiles[end_x - 1][y] = self.board.factory.createPiece('wall', end_x - 1, y)
+            self.tile_ids = floor.tile_ids
+            self.blocks_passage = self.kind_blocks_passage[self.tile_ids]
+            self.blocks_light = self.kind_blocks_light[self.tile_ids]
+        return floor.unpack_rooms()
 
-    def generate(self):
-        self.tiles = [[self.board.factory.createPiece('empty', x, y) for y in range(self.height)] for x in range(self.width)]
-        
+    def set_layers(self, tile_ids, blocks_passage, blocks_light):
+        #Swap in tile layers as they are, e.g. memory mapped from a saved game
+        self.clear()
+        self.tile_ids = tile_ids
+        self.blocks_passage = blocks_passage
+        self.blocks_light = blocks_light
+
+    def set_plan(self, plan, carved=None):
+        #Plan the rooms and corridors to be carved a chunk at a time. carved marks the chunks that
+        #already have been, e.g. in a saved game, otherwise none have and they're all blocked off.
+        self.plan = numpy.asarray(plan, dtype=numpy.int32).reshape(-1, 6)
+        self.chunk_plan = {}
+        for i, step in enumerate(self.plan.tolist()):
+            for chunk in self.step_chunks(step):
+                self.chunk_plan.setdefault(chunk, []).append(i)
+
+        if carved is None:
+            self.carved = numpy.zeros((self.chunks_x, self.chunks_y), dtype=bool)
+            self.blocks_passage[:] = True
+            self.blocks_light[:] = True
+            self.redraw_all = True
+            self.version += 1
+        else:
+            self.carved = carved
+
+    def step_chunks(self, step):
+        #The (chunk_x, chunk_y) of each chunk a row of the plan reaches into
+        kind, start_x, start_y, end_x, end_y, vault = step
+        if kind == CORRIDOR:
+            #Corridors have walls all round
+            start_x -= 1
+            start_y -= 1
+            end_x += 1
+            end_y += 1
+        return [(chunk_x, chunk_y)
+                for chunk_x in range(max(start_x, 0) // CHUNK_SIZE, min(end_x, self.width - 1) // CHUNK_SIZE + 1)
+                for chunk_y in range(max(start_y, 0) // CHUNK_SIZE, min(end_y, self.height - 1) // CHUNK_SIZE + 1)]
+
+    def carve_chunk(self, chunk_x, chunk_y):
+        #Carve the rows of the plan that reach into a chunk, in the order they were planned.
+        #Each row only depends on what the rows before it left in a cell, so carving the
+        #floor a chunk at a time gives the same floor as carving it all at once.
+        if self.carved[chunk_x, chunk_y]:
+            return
+        self.carved[chunk_x, chunk_y] = True
+
+        min_x = chunk_x * CHUNK_SIZE
+        min_y = chunk_y * CHUNK_SIZE
+        max_x = min(min_x + CHUNK_SIZE, self.width)
+        max_y = min(min_y + CHUNK_SIZE, self.height)
+        for i in self.chunk_plan.get((chunk_x, chunk_y), ()):
+            self.carve_step(self.plan[i].tolist(), (min_x, min_y, max_x, max_y))
+        self.carved_region(min_x, min_y, max_x, max_y)
+
+    def carve_step(self, step, bounds):
+        kind, start_x, start_y, end_x, end_y, vault = step
+        if kind == ROOM:
+            self.carve_room(start_x, start_y, end_x, end_y, bounds)
+        elif kind == VAULT:
+            self.carve_vault(vault, start_x, start_y, end_x, end_y, bounds)
+        else:
+            self.carve_corridor(start_x, start_y, end_x, end_y, bounds)
+
+    def carved_region(self, min_x, min_y, max_x, max_y):
+        #Pick up the flags for cells that have just been carved
+        tile_ids = self.tile_ids[min_x:max_x, min_y:max_y]
+        self.blocks_passage[min_x:max_x, min_y:max_y] = self.kind_blocks_passage[tile_ids]
+        self.blocks_light[min_x:max_x, min_y:max_y] = self.kind_blocks_light[tile_ids]
+        self.redraw_all = True
+        self.version += 1
+        if self.board.map is self:
+            self.board.refresh_region(min_x, min_y, max_x, max_y)
+
+    def carve_cell(self, x, y):
+        #Make sure the chunk holding a cell has been carved before anything looks at it
+        if not self.carved[x // CHUNK_SIZE, y // CHUNK_SIZE]:
+            self.carve_chunk(x // CHUNK_SIZE, y // CHUNK_SIZE)
+
+    def carve_around(self, x, y):
+        #Carve the chunks near a cell, called as the player moves
+        chunk_x = x // CHUNK_SIZE
+        chunk_y = y // CHUNK_SIZE
+        for near_x in range(max(chunk_x - CARVE_RADIUS, 0), min(chunk_x + CARVE_RADIUS + 1, self.chunks_x)):
+            for near_y in range(max(chunk_y - CARVE_RADIUS, 0), min(chunk_y + CARVE_RADIUS + 1, self.chunks_y)):
+                if not self.carved[near_x, near_y]:
+                    self.carve_chunk(near_x, near_y)
+
+    def carve_all(self):
+        if self.carved.any():
+            for chunk_x in range(self.chunks_x):
+                for chunk_y in range(self.chunks_y):
+                    self.carve_chunk(chunk_x, chunk_y)
+            return
+
+        #Nothing's been carved yet, so each step can be carved once over just the cells it covers
+        for step in self.plan.tolist():
+            kind, start_x, start_y, end_x, end_y, vault = step
+            if kind == CORRIDOR:
+                start_x -= 1
+                start_y -= 1
+                end_x += 1
+                end_y += 1
+            self.carve_step(step, (max(start_x, 0), max(start_y, 0), min(end_x + 1, self.width), min(end_y + 1, self.height)))
+        self.carved[:] = True
+        self.carved_region(0, 0, self.width, self.height)
+
+    def label_regions(self):
+        #Number the connected regions of cells that can be walked on into self.regions, with
+        #diagonal steps connecting cells as they do for pieces and 0 for everything else. Empty
+        #cells don't block passage but are only the void nothing was carved into, so they're
+        #left out like walls. The whole floor is carved first. Anything that wants to know what
+        #can reach what can share these through region_labels.
+        self.carve_all()
+        walkable = ~self.blocks_passage & (self.tile_ids != EMPTY)
+        self.regions, self.region_count = label(walkable, structure=WALL_PADDING)
+        return self.regions
+
+    def region_labels(self):
+        #self.regions, labelling the floor first if it hasn't been since it last changed
+        if self.regions is None:
+            self.label_regions()
+        return self.regions
+
+    def validate(self, rooms):
+        """Checks the down stairs in the second room can be reached from the first, where the
+        player starts, by labelling the floor's regions. Floors bigger than VALIDATE_CELLS with a
+        plan are checked with plan_connects instead, so they don't have to be carved. If they
+        can't be, a corridor between the two rooms is added to the plan and carved into any
+        chunks that already have been, so the floor still comes out the same when it's carved
+        lazily from the plan. Returns True if the floor had to be repaired."""
+        if len(rooms) < 2:
+            return False
+
+        start = rooms[0]
+        stairs = rooms[1]
+        labelled = not len(self.plan) or self.width * self.height <= VALIDATE_CELLS
+        if labelled:
+            regions = self.label_regions()
+            if regions[start.center_x, start.center_y] == regions[stairs.center_x, stairs.center_y]:
+                return False
+        elif self.plan_connects(start, stairs):
+            return False
+
+        first = len(self.plan)
+        self.set_plan(numpy.concatenate((self.plan, numpy.array(connect_rooms(start, stairs), dtype=numpy.int32))), self.carved)
+        chunks = set(chunk for step in self.plan[first:].tolist() for chunk in self.step_chunks(step))
+        for chunk_x, chunk_y in sorted(chunks):
+            if self.carved[chunk_x, chunk_y]:
+                min_x = chunk_x * CHUNK_SIZE
+                min_y = chunk_y * CHUNK_SIZE
+                bounds = (min_x, min_y, min(min_x + CHUNK_SIZE, self.width), min(min_y + CHUNK_SIZE, self.height))
+                for step in self.plan[first:].tolist():
+                    self.carve_step(step, bounds)
+                self.carved_region(*bounds)
+
+        self.regions = None
+        if labelled:
+            self.label_regions()
+        return True
+
+    def plan_connects(self, room1, room2):
+        """Whether the plan joins the centers of two rooms, without carving anything. Starting
+        from the rows that open up the first center it follows rows whose open cells are next to
+        each other, see steps_touch, until it gets to one that opens up the second. Rows can only
+        be next to each other if they reach into the same chunk, so chunk_plan gives the rows to
+        try. This relies on rows never walling over the rows planned before them, which holds
+        because later rooms are always in a different part of the BSP tree."""
+        plan = self.plan.tolist()
+
+        def rows_at(x, y):
+            rows = []
+            for i in self.chunk_plan.get((x // CHUNK_SIZE, y // CHUNK_SIZE), ()):
+                min_x, min_y, max_x, max_y = step_floor(plan[i])
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    rows.append(i)
+            return rows
+
+        goals = set(rows_at(room2.center_x, room2.center_y))
+        waiting = rows_at(room1.center_x, room1.center_y)
+        seen = set(waiting)
+        while waiting:
+            i = waiting.pop()
+            if i in goals:
+                return True
+            for chunk in self.step_chunks(plan[i]):
+                for j in self.chunk_plan[chunk]:
+                    if j not in seen and steps_touch(plan[i], plan[j]):
+                        seen.add(j)
+                        waiting.append(j)
+        return False
+
+    def set_tile(self, x, y, kind):
+        self.carve_cell(x, y)
+        tile_id = TILE_KINDS.index(kind)
+        if self.blocks_passage[x, y] != self.kind_blocks_passage[tile_id]:
+            self.regions = None
+        self.tile_ids[x, y] = tile_id
+        self.blocks_passage[x, y] = self.kind_blocks_passage[tile_id]
+        self.blocks_light[x, y] = self.kind_blocks_light[tile_id]
+        self.tile_pieces.pop((x, y), None)
+        self.mark_dirty(x, y)
+        self.version += 1
+
+    def mark_dirty(self, x, y):
+        if not self.redraw_all:
+            self.dirty.add((x, y))
+
+    def find_tile(self, tile_id):
+        #The first cell holding a tile_id tile
+        x, y = numpy.argwhere(self.tile_ids == tile_id)[0]
+        return int(x), int(y)
+
+    def kind_at(self, x, y):
+        self.carve_cell(x, y)
+        return TILE_KINDS[self.tile_ids[x, y]]
+
+    def tile_at(self, x, y):
+        self.carve_cell(x, y)
+        tile = self.tile_pieces.get((x, y))
+        if tile is None:
+            tile = self.board.factory.createTile(self.tile_ids[x, y], x, y)
+        return tile
+
+    def tile_changed(self, x, y):
+        #Called by a Tile when it's changed e.g. by a growth spell
+        tile = self.tile_pieces[(x, y)]
+        if self.blocks_passage[x, y] != tile.blocks_passage:
+            self.regions = None
+        self.blocks_passage[x, y] = tile.blocks_passage
+        self.blocks_light[x, y] = tile.blocks_light
+        self.mark_dirty(x, y)
+        self.version += 1
+        self.board.refresh_cell(x, y)
+
+    def sprite_at(self, x, y):
+        tile = self.tile_pieces.get((x, y))
+        if tile is None:
+            tile = self.tile_types[self.tile_ids[x, y]]
+        return tile.sprite
+
+    def is_blocked(self, x, y):
+        self.carve_cell(x, y)
+        return self.blocks_passage[x, y]
+
+    def carve_room(self, start_x, start_y, end_x, end_y, bounds):
+        #The part of a room that's inside bounds, (min_x, min_y, max_x, max_y). Walls all over
+        #and then floor over everything but the border.
+        min_x, min_y, max_x, max_y = bounds
+        tile_ids = self.tile_ids[min_x:max_x, min_y:max_y]
+        tile_ids[clipped(start_x, end_x, min_x, max_x), clipped(start_y, end_y, min_y, max_y)] = WALL
+        tile_ids[clipped(start_x + 1, end_x - 1, min_x, max_x), clipped(start_y + 1, end_y - 1, min_y, max_y)] = FLOOR
+
+    def carve_vault(self, vault, start_x, start_y, end_x, end_y, bounds):
+        #Stamp the part of a VAULTS template that's inside bounds
+        min_x, min_y, max_x, max_y = bounds
+        vault_ids, vault_mask = VAULT_TILES[vault]
+        inside = (clipped(min_x, max_x - 1, start_x, end_x + 1), clipped(min_y, max_y - 1, start_y, end_y + 1))
+        tile_ids = self.tile_ids[min_x:max_x, min_y:max_y][clipped(start_x, end_x, min_x, max_x), clipped(start_y, end_y, min_y, max_y)]
+        mask = vault_mask[inside]
+        tile_ids[mask] = vault_ids[inside][mask]
+
+    def carve_corridor(self, start_x, start_y, end_x, end_y, bounds):
+        #The part of a corridor that's inside bounds. It runs along end_y from start_x to end_x
+        #then along end_x from start_y to end_y, and the cells around it get walls wherever
+        #nothing's been carved. The walls are found by dilating the corridor over a window one
+        #cell bigger than bounds, so corridor just outside bounds still puts its walls inside.
+        min_x, min_y, max_x, max_y = bounds
+        low_x = min_x - 1
+        low_y = min_y - 1
+        high_x = max_x + 1
+        high_y = max_y + 1
+        corridor = numpy.zeros((high_x - low_x, high_y - low_y), dtype=bool)
+        corridor[clipped(start_x, end_x, low_x, high_x), clipped(end_y, end_y, low_y, high_y)] = True
+        corridor[clipped(end_x, end_x, low_x, high_x), clipped(start_y, end_y, low_y, high_y)] = True
+        walls = binary_dilation(corridor, structure=WALL_PADDING)[1:-1, 1:-1]
+        corridor = corridor[1:-1, 1:-1]
+
+        tile_ids = self.tile_ids[min_x:max_x, min_y:max_y]
+        tile_ids[corridor] = FLOOR
+        tile_ids[walls & (tile_ids == EMPTY)] = WALL
+
+    def generate_any(self, depth=BSP_DEPTH, cave_chance=CAVE_CHANCE):
+        #Generate caves or rooms and corridors, whichever the board's generators pick, and make
+        #sure the stairs can be reached
+        if cave_chance > 0 and self.board.random.random() < cave_chance:
+            rooms = self.generate_caves()
+        else:
+            rooms = self.generate(depth)
+        self.validate(rooms)
+        return rooms
+
+    def generate(self, depth=BSP_DEPTH, extra_loops=EXTRA_LOOPS, vault_chance=VAULT_CHANCE):
+        self.clear()
+        if self.width * self.height >= PART_CELLS and depth > PART_LEVELS:
+            rooms, plan = self.plan_parts(depth, extra_loops, vault_chance)
+        else:
+            rooms, plan = self.plan_rooms(0, 0, self.width, self.height, depth, extra_loops, vault_chance)
+        self.set_plan(plan)
+        return rooms
+
+    def plan_parts(self, depth, extra_loops, vault_chance):
+        """Plan a big floor in parts. The top PART_LEVELS levels of the BSP tree are split here
+        and each leaf is planned by plan_part with a seed of its own, in the FloorGenerator's part
+        worker processes if the board has one. The seeds are drawn here, so the floor is the
+        same whether the parts are planned in parallel or one after another. The parts are
+        then joined by a minimum spanning tree of the shortest corridors between the closest
+        rooms of each pair of neighbouring parts. Returns (rooms, plan)."""
         bsp_root = libtcod.bsp_new_with_size(0, 0, self.width, self.height)
-        libtcod.bsp_split_recursive(bsp_root, None, 8, minHSize=11, minVSize=11, maxHRatio=1.0, maxVRatio=1.0)
+        libtcod.bsp_split_recursive(bsp_root, self.board.libtcod_random, PART_LEVELS, minHSize=11, minVSize=11, maxHRatio=1.0, maxVRatio=1.0)
+        parts = []
+        nodes = [bsp_root]
+        while nodes:
+            node = nodes.pop()
+            if libtcod.bsp_is_leaf(node):
+                parts.append((node.x, node.y, node.w, node.h))
+            else:
+                nodes.append(libtcod.bsp_right(node))
+                nodes.append(libtcod.bsp_left(node))
+        libtcod.bsp_delete(bsp_root)
+
+        arguments = [part + (self.board.random.randrange(2 ** 32), depth - PART_LEVELS, extra_loops, vault_chance) for part in parts]
+        if self.board.floor_generator is not None:
+            results = self.board.floor_generator.map(plan_part, arguments)
+        else:
+            results = [plan_part(part_arguments) for part_arguments in arguments]
 
         rooms = []
-        self.process_node(bsp_root, rooms)
+        plan = []
+        centers = []
+        first_rooms = []
+        for part_rooms, part_plan in results:
+            first_rooms.append(len(rooms))
+            rooms.extend(part_rooms)
+            plan.extend(part_plan)
+            centers.append(numpy.array([(room.center_x, room.center_y) for room in part_rooms], dtype=numpy.float64))
 
-        for room in rooms:
-            self.carve_room(room.x, room.y, room.width, room.height)
+        #The closest pair of rooms between each pair of neighbouring parts
+        links = {}
+        starts = []
+        ends = []
+        distances = []
+        for i in range(len(parts)):
+            for j in range(i + 1, len(parts)):
+                if not touching(parts[i], parts[j]):
+                    continue
+                distance, nearest = cKDTree(centers[j]).query(centers[i], p=1)
+                closest = numpy.argmin(distance)
+                links[(i, j)] = (first_rooms[i] + int(closest), first_rooms[j] + int(nearest[closest]))
+                starts.append(i)
+                ends.append(j)
+                distances.append(distance[closest])
 
-        full_graph = csr_matrix([[room1.distance_to(room2) for room1 in rooms] for room2 in rooms])
-        minimum_spanning_graph = minimum_spanning_tree(full_graph)
-        indexes = minimum_spanning_graph.nonzero()
+        part_graph = coo_matrix((distances, (starts, ends)), shape=(len(parts), len(parts))).tocsr()
+        for i, j in zip(*minimum_spanning_tree(part_graph).nonzero()):
+            room1, room2 = links[(min(i, j), max(i, j))]
+            plan.extend(connect_rooms(rooms[room1], rooms[room2]))
 
-        for i in range(len(indexes[0])):
-            room1 = rooms[indexes[0][i]]
-            room2 = rooms[indexes[1][i]]
-            self.carve_corridor(room1.center_x, room1.center_y, room2.center_x, room1.center_y)
-            self.carve_corridor(room2.center_x, room1.center_y, room2.center_x, room2.center_y)
+        return rooms, plan
 
-        return rooms
+    def plan_rooms(self, x, y, width, height, depth, extra_loops, vault_chance):
+        #Rooms and the corridors joining them for the part of the map from (x, y), returns (rooms, plan)
+        bsp_root = libtcod.bsp_new_with_size(x, y, width, height)
+        libtcod.bsp_split_recursive(bsp_root, self.board.libtcod_random, depth, minHSize=11, minVSize=11, maxHRatio=1.0, maxVRatio=1.0)
+
+        rooms = []
+        self.process_node(bsp_root, rooms, vault_chance)
+        libtcod.bsp_delete(bsp_root)
+
+        plan = [room_step(room) for room in rooms]
+
+        candidate_graph = room_graph(rooms)
+        minimum_spanning_graph = minimum_spanning_tree(candidate_graph)
+        starts, ends = minimum_spanning_graph.nonzero()
+        corridors = zip(starts.tolist(), ends.tolist())
+
+        if extra_loops > 0:
+            #Some of the candidates that weren't needed, so there's more than one way round
+            needed = set(corridors)
+            for corridor in zip(*candidate_graph.nonzero()):
+                if corridor not in needed and (corridor[1], corridor[0]) not in needed and self.board.random.random() < extra_loops:
+                    corridors.append(corridor)
+
+        for i, j in corridors:
+            plan.extend(connect_rooms(rooms[i], rooms[j]))
+
+        return rooms, plan
+
+    def generate_caves(self, fill=CAVE_FILL, steps=CAVE_STEPS):
+        """Generate a cave with a cellular automaton run over the whole map at once. Cells start
+        as wall at random and are smoothed by counting the walls around every cell with a
+        convolution. Only the largest connected open region is kept, walled in, so everything
+        on the floor can be reached. Like generate it returns Rooms for the player, the stairs
+        and then each orc, here one cell rooms spread over the cave."""
+        self.clear()
+        rng = self.board.numpy_random
+
+        wall = rng.random_sample((self.width, self.height)) < fill
+        neighbourhood = numpy.ones((3, 3), dtype=numpy.uint8)
+        for i in range(steps):
+            #Off the map counts as wall
+            walls_around = convolve(wall.view(numpy.uint8), neighbourhood, mode='constant', cval=1)
+            wall = walls_around >= 5
+        #Keep the edge solid so the cave's walls fit on the map
+        wall[[0, -1], :] = True
+        wall[:, [0, -1]] = True
 
-    def process_node(self, node, rooms):
+        #Pieces move diagonally, so diagonal neighbours are connected too
+        regions, count = label(~wall, structure=WALL_PADDING)
+        if count == 0:
+            return self.generate()
+        sizes = numpy.bincount(regions.ravel())
+        sizes[0] = 0
+        cave = regions == numpy.argmax(sizes)
+
+        self.tile_ids[binary_dilation(cave, structure=WALL_PADDING)] = WALL
+        self.tile_ids[cave] = FLOOR
+        self.blocks_passage = self.kind_blocks_passage[self.tile_ids]
+        self.blocks_light = self.kind_blocks_light[self.tile_ids]
+        self.version += 1
+
+        #The player starts somewhere at random with the stairs as far away as they can be
+        open_cells = numpy.argwhere(cave)
+        start = open_cells[rng.randint(len(open_cells))]
+        stairs = open_cells[numpy.argmax(((open_cells - start) ** 2).sum(axis=1))]
+        orcs = open_cells[rng.choice(len(open_cells), min(len(open_cells) // CAVE_CELLS_PER_ORC, len(open_cells)), replace=False)]
+        orcs = orcs[((orcs != start).any(axis=1)) & ((orcs != stairs).any(axis=1))]
+        return [Room(x, y, 1, 1) for x, y in [start.tolist(), stairs.tolist()] + orcs.tolist()]
+
+    def process_node(self, node, rooms, vault_chance=0.0):
         if libtcod.bsp_is_leaf(node):
-            width = random.randint(7, node.w)
-            height = random.randint(7, node.h)
-            x = random.randint(node.x, node.x+node.w-width)
-            y = random.randint(node.y, node.y+node.h-height)
-            rooms.append(Room(x, y, width, height))
+            rng = self.board.random
+            vault = None
+            if vault_chance > 0 and rng.random() < vault_chance:
+                fits = [i for i, (vault_ids, vault_mask) in enumerate(VAULT_TILES) if vault_ids.shape[0] <= node.w and vault_ids.shape[1] <= node.h]
+                if fits:
+                    vault = rng.choice(fits)
+
+            if vault is None:
+                width = rng.randint(7, node.w)
+                height = rng.randint(7, node.h)
+            else:
+                width, height = VAULT_TILES[vault][0].shape
+            x = rng.randint(node.x, node.x+node.w-width)
+            y = rng.randint(node.y, node.y+node.h-height)
+            rooms.append(Room(x, y, width, height, vault))
         else:
-            self.process_node(libtcod.bsp_left(node), rooms)
-            self.process_node(libtcod.bsp_right(node), rooms)
+            self.process_node(libtcod.bsp_left(node), rooms, vault_chance)
+            self.process_node(libtcod.bsp_right(node), rooms, vault_chance)
 
 class Board(object):
     """The Board represents one whole floor of the dungeon with a map, and a list of moving peices.
-    It also contains the logic for moving around and fighting."""
-    def __init__(self, width, height):
+    It also contains the logic for moving around and fighting.
+    Everything random on the board draws from the board's own generators, see seed. The
+    player's field of view is worked out with a libtcod FOV algorithm out to fov_radius, 0 for
+    no limit."""
+    def __init__(self, width, height, seed=None, fov_algorithm=fov.FOV_ALGORITHM, fov_radius=fov.FOV_RADIUS):
         self.width = width
         self.height = height
+        self.libtcod_random = None
+        self.seed(seed)
         self.factory = game_piece.PieceFactory(self)
         self.map = Map(self, width, height)
+        self.renderer = render.Renderer(self)
         self.player = self.factory.createPiece('player')
+        self.pieces = []
+        #The pieces in each cell, keyed by (x, y), in the same order as self.pieces
+        self.piece_index = {}
+        #Cells holding a blocking piece, and those merged with the map's blocking tiles
+        self.occupied = numpy.zeros((width, height), dtype=bool)
+        self.blocked = numpy.zeros((width, height), dtype=bool)
+        self.fov = fov.FieldOfView(self, fov_algorithm, fov_radius)
+        self.flow = pathing.FlowField(self)
+        #Set to a FloorGenerator to have the next floor generated in the background
+        self.floor_generator = None
+        #How many floors down the player is, and the floors they've left
+        self.depth = 0
+        self.floor_seed = None
+        self.floor_cache = floor_cache.FloorCache()
+        #The pieces made along with the floor, in the order they were made
+        self.generated_pieces = []
 
-    def draw(self, console):
-        self.map.draw(console)
+    def seed(self, seed=None):
+        #Restart the board's random number generators from seed, the same seed gives the same
+        #floors and fights. With no seed one is picked, it's kept in self.random_seed for replays.
+        if seed is None:
+            seed = random.SystemRandom().randrange(2 ** 32)
+        self.random_seed = seed
+        #Every floor is generated and played from a seed of its own taken from this stream,
+        #so the next floor's seed is known in advance and it can be generated ahead of time
+        self.floor_seeds = random.Random(seed)
+        self.next_floor_seed = self.floor_seeds.randrange(2 ** 32)
+        self.seed_generators(seed)
 
-        for piece in self.pieces:
-            piece.draw(console)
+    def seed_generators(self, seed):
+        self.random = random.Random(seed)
+        self.numpy_random = numpy.random.RandomState(seed)
+
+        if self.libtcod_random is not None:
+            libtcod.random_delete(self.libtcod_random)
+        self.libtcod_random = libtcod.random_new_from_seed(seed)
+
+    def draw(self, console):
+        self.renderer.draw(console)
 
     def generate(self):
-        rooms = self.map.generate()
+        #Make a new floor at the current depth from the next floor seed
+        floor_seed = self.next_floor_seed
+        self.next_floor_seed = self.floor_seeds.randrange(2 ** 32)
+
+        floor = None
+        if self.floor_generator is not None:
+            floor = self.floor_generator.take(self.width, self.height, floor_seed)
+
+        self.build_floor(floor_seed, floor)
+
+        if self.floor_generator is not None:
+            self.floor_generator.start(self.width, self.height, self.next_floor_seed)
+
+    def build_floor(self, floor_seed, floor=None):
+        #Set up the floor for floor_seed, from the already generated floor if there is one.
+        #Generating here starts from the same state generate_floor does so either way gives the same floor.
+        self.floor_seed = floor_seed
+        self.game.clear_actors()
+        self.pieces = []
+        self.piece_index = {}
+        self.occupied[:] = False
+        self.generated_pieces = []
+
+        self.map = Map(self, self.width, self.height)
+        self.seed_generators(floor_seed)
+        if floor is None:
+            rooms = self.map.generate_any()
+        else:
+            rooms = self.map.load(floor)
+        self.seed_generators(floor_seed)
+        self.blocked = self.map.blocks_passage.copy()
 
         for i in range(len(rooms)):
             if i == 0:
                 self.player.x = rooms[i].center_x
                 self.player.y = rooms[i].center_y
-                self.pieces = [self.player]
+                self.map.carve_around(self.player.x, self.player.y)
+                if self.depth > 0:
+                    self.map.set_tile(self.player.x, self.player.y, 'up_stairs')
+                self.add_piece(self.player)
                 self.game.add_actor(self.player)
             elif i == 1:
                 x = rooms[i].center_x
                 y = rooms[i].center_y
-                self.map.tiles[x][y] = self.factory.createPiece('down_stairs', x, y)
+                self.map.set_tile(x, y, 'down_stairs')
             else:
                 orc = self.factory.createPiece('orc', rooms[i].center_x, rooms[i].center_y)
-                self.pieces.append(orc)
+                self.add_piece(orc)
                 self.game.add_actor(orc)
+                self.generated_pieces.append(orc)
+
+        #Pick up the stairs
+        self.blocked = self.map.blocks_passage | self.occupied
+        self.fov.rebuild()
+
+    def change_floor(self, depth):
+        #Leave this floor for the one at depth, going back to it if it's been visited before.
+        #The player arrives on the stairs leading back to where they came from.
+        stairs = UP_STAIRS if depth > self.depth else DOWN_STAIRS
+        self.floor_cache.put(floor_cache.VisitedFloor(self))
+
+        floor = self.floor_cache.take(depth)
+        self.depth = depth
+        if floor is None:
+            self.generate()
+        else:
+            floor.restore(self, stairs)
+
+    def place_pieces(self, pieces, x, y):
+        #Fill the board with pieces, which include the player, and put the player on (x, y)
+        #or the closest free cell to it if something is standing there
+        self.game.clear_actors()
+        self.pieces = []
+        self.piece_index = {}
+        self.occupied[:] = False
+        self.blocked = self.map.blocks_passage.copy()
+        for piece in pieces:
+            if piece is not self.player:
+                self.add_piece(piece)
+
+        if self.blocked[x, y]:
+            free = numpy.argwhere(~self.blocked)
+            x, y = free[numpy.argmin(((free - (x, y)) ** 2).sum(axis=1))]
+        self.player.x = int(x)
+        self.player.y = int(y)
+        self.map.carve_around(self.player.x, self.player.y)
+        self.add_piece(self.player)
+        #Keep them in the order they were given, it's the order they're drawn and targeted in
+        self.pieces = list(pieces)
+
+        #The player goes first so the actors around them are woken
+        self.game.add_actor(self.player)
+        for piece in pieces:
+            if piece.ai and piece is not self.player:
+                self.game.add_actor(piece)
+
+        self.fov.rebuild()
+
+    def add_piece(self, piece):
+        self.pieces.append(piece)
+        self.piece_index.setdefault((piece.x, piece.y), []).append(piece)
+        self.refresh_cell(piece.x, piece.y)
+
+    def move_piece(self, piece, x, y):
+        self.unindex_piece(piece)
+        piece.x = x
+        piece.y = y
+
+        #Only corpses share a cell with a moving piece and they're moved to the back,
+        #so appending keeps the cell in the same order as self.pieces
+        self.piece_index.setdefault((x, y), []).append(piece)
+        self.refresh_cell(x, y)
+
+        if piece is self.player:
+            self.map.carve_around(x, y)
+
+    def unindex_piece(self, piece):
+        cell = self.piece_index[(piece.x, piece.y)]
+        cell.remove(piece)
+        if not cell:
+            del self.piece_index[(piece.x, piece.y)]
+        self.refresh_cell(piece.x, piece.y)
+
+    def refresh_cell(self, x, y):
+        #Update the occupancy grid for a cell, called whenever a piece or tile there changes
+        occupied = False
+        transparent = not self.map.blocks_light[x, y]
+        for piece in self.piece_index.get((x, y), ()):
+            if piece.blocks_passage:
+                occupied = True
+            if piece.blocks_light:
+                transparent = False
+
+        self.occupied[x, y] = occupied
+        self.blocked[x, y] = occupied or self.map.blocks_passage[x, y]
+        self.fov.cell_changed(x, y, transparent)
+
+    def refresh_region(self, min_x, min_y, max_x, max_y):
+        #Update the occupancy grid for a block of cells after the map under them has been carved,
+        #the pieces standing there haven't changed
+        self.blocked[min_x:max_x, min_y:max_y] = self.map.blocks_passage[min_x:max_x, min_y:max_y] | self.occupied[min_x:max_x, min_y:max_y]
+        transparent = ~self.map.blocks_light[min_x:max_x, min_y:max_y]
+        for piece in self.pieces:
+            if piece.blocks_light and min_x <= piece.x < max_x and min_y <= piece.y < max_y:
+                transparent[piece.x - min_x, piece.y - min_y] = False
+        self.fov.region_changed(min_x, min_y, transparent)
+
+    def blocked_around(self, x, y):
+        #The 3x3 blocking mask centered on (x, y), indexed [dx + 1, dy + 1]
+        return self.blocked_region(x - 1, y - 1, x + 2, y + 2)
+
+    def blocked_region(self, start_x, start_y, end_x, end_y):
+        #The blocking mask for start_x <= x < end_x and start_y <= y < end_y, indexed from the start
+        #corner. Cells off the board count as blocked.
+        mask = numpy.ones((end_x - start_x, end_y - start_y), dtype=bool)
+        min_x = max(start_x, 0)
+        min_y = max(start_y, 0)
+        max_x = min(end_x, self.width)
+        max_y = min(end_y, self.height)
+        if min_x < max_x and min_y < max_y:
+            mask[min_x - start_x:max_x - start_x, min_y - start_y:max_y - start_y] = self.blocked[min_x:max_x, min_y:max_y]
+        return mask
 
     def move_to_back(self, piece):
         #Move a piece to the start of the list so they are drawn first
         self.pieces.remove(piece)
         self.pieces.insert(0, piece)
 
+        cell = self.piece_index[(piece.x, piece.y)]
+        cell.remove(piece)
+        cell.insert(0, piece)
+
     def pieces_at(self, x, y):
         found_pieces = []
-        found_pieces.append(self.map.tiles[x][y])
-
-        for piece in self.pieces:
-            if piece.x == x and piece.y == y:
-                found_pieces.append(piece)
+        found_pieces.append(self.map.tile_at(x, y))
+        found_pieces.extend(self.piece_index.get((x, y), ()))
 
         return found_pieces
 
     def is_blocked(self, x, y):
+        #Most cells aren't blocked, the occupancy grid answers those without looking any further
+        if not self.blocked[x, y]:
+            return False
+
         #Is the tile at this location blocking
-        if self.map.tiles[x][y].blocks_passage:
+        if self.map.is_blocked(x, y):
             #Set the blocking_piece, and break out of the loop
-            blocking_piece = self.map.tiles[x][y]
+            blocking_piece = self.map.tile_at(x, y)
             return blocking_piece
 
         #Are any blocking pieces in this location
         blocking_piece = None
-        for piece in self.pieces:
-            if piece.blocks_passage and piece.x == x and piece.y == y:
+        for piece in self.piece_index.get((x, y), ()):
+            if piece.blocks_passage:
                 #Set the blocking_piece, and break out of the loop
                 blocking_piece = piece
                 return blocking_piece
@@ -0,0 +1,153 @@
+import libtcodpy as libtcod
+import collections
+import numpy
+import game_piece
+
+#How many of the floors the player has left are kept whole, older ones are kept as a FloorJournal
+FLOOR_CACHE_SIZE = 3
+
+def piece_state(piece):
+    #The parts of a piece or tile that can change during play, as plain values
+    fighter = None
+    if piece.fighter:
+        death = game_piece.DEATH_FUNCTIONS.index(piece.fighter.death_function)
+        fighter = (piece.fighter.max_hp, piece.fighter.hp, piece.fighter.power, death)
+    frozen = bool(piece.status and piece.status.frozen)
+    return (piece.name, piece.sprite.char, tuple(piece.sprite.color), piece.blocks_passage, piece.blocks_light, frozen, fighter)
+
+def restore_piece_state(piece, state):
+    name, char, color, blocks_passage, blocks_light, frozen, fighter = state
+    piece.name = name
+    piece.sprite = game_piece.Sprite(char, libtcod.Color(*color))
+    piece.blocks_passage = blocks_passage
+    piece.blocks_light = blocks_light
+    if piece.status:
+        piece.status.frozen = frozen
+
+    if fighter is None:
+        #Dead, or never had a fighter
+        if piece.fighter:
+            piece.fighter = None
+            piece.ai = None
+    else:
+        max_hp, hp, power, death = fighter
+        if not piece.fighter:
+            piece.fighter = game_piece.Fighter(hp=max_hp, power=power)
+            piece.fighter.owner = piece
+        #A corpse that's been grown into a tree dies like a wall, not like the monster it was
+        piece.fighter.death_function = game_piece.DEATH_FUNCTIONS[death]
+        piece.fighter.max_hp = max_hp
+        piece.fighter.hp = hp
+        piece.fighter.power = power
+
+class VisitedFloor(object):
+    """A floor the player has left, kept whole: its Map, the pieces on it in drawing order,
+    the pieces generated with it in the order they were made and what the player explored."""
+    def __init__(self, board):
+        self.depth = board.depth
+        self.seed = board.floor_seed
+        self.map = board.map
+        self.pieces = list(board.pieces)
+        self.generated_pieces = board.generated_pieces
+        self.explored = board.fov.explored.copy()
+
+    def restore(self, board, stairs):
+        #Make this the board's floor again, with the player on the stairs of the given kind
+        board.depth = self.depth
+        board.floor_seed = self.seed
+        board.map = self.map
+        board.map.redraw_all = True
+        board.generated_pieces = self.generated_pieces
+        x, y = board.map.find_tile(stairs)
+        board.place_pieces(self.pieces, x, y)
+        board.fov.explored[:] = self.explored
+
+def journal_floor(floor):
+    #Boil a VisitedFloor down to a FloorJournal
+
+    #One (x, y, state) row for each tile that no longer matches its TileType
+    tiles = []
+    for (x, y), tile in sorted(floor.map.tile_pieces.items()):
+        tile_type = tile.tile_type
+        pristine = (tile_type.name, tile_type.sprite.char, tuple(tile_type.sprite.color),
+                    tile_type.blocks_passage, tile_type.blocks_light, False, None)
+        state = piece_state(tile)
+        if state != pristine:
+            tiles.append((x, y, state))
+
+    #One (index, x, y, state) row for each piece in drawing order, index is the order it was
+    #generated in or -1 for the player, who just needs their place in the order keeping
+    generated_index = dict((id(piece), i) for i, piece in enumerate(floor.generated_pieces))
+    pieces = [(generated_index.get(id(piece), -1), piece.x, piece.y, piece_state(piece)) for piece in floor.pieces]
+
+    return FloorJournal(floor.depth, floor.seed, tiles, pieces, floor.explored.shape, numpy.packbits(floor.explored))
+
+class FloorJournal(object):
+    """A floor the player has left boiled down to its seed and what's changed since it was
+    generated: tiles that have been grown, frozen or carved, and where each generated piece
+    is now and what state it's in. Restoring it generates the floor again from the seed and
+    plays the changes back onto it. Made from a VisitedFloor by journal_floor."""
+    def __init__(self, depth, seed, tiles, pieces, shape, explored):
+        self.depth = depth
+        self.seed = seed
+        self.tiles = tiles
+        self.pieces = pieces
+        #The explored cells packed into bits
+        self.shape = shape
+        self.explored = explored
+
+    def restore(self, board, stairs):
+        board.depth = self.depth
+
+        #Generating the floor again mustn't disturb the random numbers used during play
+        random_state = board.random.getstate()
+        numpy_state = board.numpy_random.get_state()
+        board.build_floor(self.seed)
+        board.random.setstate(random_state)
+        board.numpy_random.set_state(numpy_state)
+
+        for tile_x, tile_y, state in self.tiles:
+            restore_piece_state(board.map.tile_at(tile_x, tile_y), state)
+
+        pieces = []
+        for index, piece_x, piece_y, state in self.pieces:
+            if index < 0:
+                pieces.append(board.player)
+                continue
+            piece = board.generated_pieces[index]
+            piece.x = piece_x
+            piece.y = piece_y
+            restore_piece_state(piece, state)
+            pieces.append(piece)
+        x, y = board.map.find_tile(stairs)
+        board.place_pieces(pieces, x, y)
+
+        size = self.shape[0] * self.shape[1]
+        board.fov.explored[:] = numpy.unpackbits(self.explored)[:size].reshape(self.shape).astype(bool)
+
+class FloorCache(object):
+    """Keeps the floors the player has left so they can go back to them, keyed by depth. The
+    most recently left floors are kept whole as VisitedFloors, when there are more than size of
+    them the least recently visited is turned into a FloorJournal."""
+    def __init__(self, size=FLOOR_CACHE_SIZE):
+        self.size = size
+        #Least recently visited first
+        self.floors = collections.OrderedDict()
+        self.journals = {}
+
+    def put(self, floor):
+        self.floors[floor.depth] = floor
+        while len(self.floors) > self.size:
+            depth, evicted = self.floors.popitem(last=False)
+            self.journals[depth] = journal_floor(evicted)
+
+    def take(self, depth):
+        #The floor at depth as a VisitedFloor or FloorJournal, or None if it's never been visited
+        floor = self.floors.pop(depth, None)
+        if floor is None:
+            floor = self.journals.pop(depth, None)
+        return floor
+
+    def clear(self):
+        self.floors.clear()
+        self.journals.clear()
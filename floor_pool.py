@@ -0,0 +1,48 @@
+import multiprocessing
+import dungeon
+
+class FloorGenerator(object):
+    """Generates floors ahead of time in a pool of worker processes. The Board starts the next
+    floor as soon as the current one is ready and takes it when the player goes down the stairs,
+    so descending only has to swap the floor in. Floors are matched up by size and seed, the
+    seed decides everything about a floor so one made here is the same as one made in place.
+    Big floors generated in place are planned in parts, see Map.plan_parts. The parts are spread
+    over a second pool that's only started the first time a floor that big comes along, with one
+    process per core unless part_processes says otherwise."""
+    def __init__(self, processes=1, part_processes=None):
+        self.pool = multiprocessing.Pool(processes)
+        self.part_pool = None
+        self.part_processes = part_processes
+        #Results that haven't been taken yet, keyed by (width, height, seed)
+        self.pending = {}
+
+    def start(self, width, height, seed):
+        key = (width, height, seed)
+        if key not in self.pending:
+            self.pending[key] = self.pool.apply_async(dungeon.generate_floor, key)
+
+    def take(self, width, height, seed):
+        #The floor for seed, waiting for it if it's still being generated,
+        #or None if it was never started
+        result = self.pending.pop((width, height, seed), None)
+
+        #Anything else is for floors that will never be visited
+        self.pending.clear()
+
+        if result is None:
+            return None
+        return result.get()
+
+    def map(self, function, arguments):
+        #function called on each of arguments in the part processes, waits for all the results
+        if self.part_pool is None:
+            self.part_pool = multiprocessing.Pool(self.part_processes)
+        return self.part_pool.map(function, arguments)
+
+    def close(self):
+        for pool in (self.pool, self.part_pool):
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self.part_pool = None
+        self.pending.clear()
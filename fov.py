@@ -0,0 +1,191 @@
+import libtcodpy as libtcod
+import numpy
+
+FOV_ALGORITHM = libtcod.FOV_RESTRICTIVE
+FOV_RADIUS = 10
+FOV_LIGHT_WALLS = True
+
+class FieldOfView(object):
+    """Works out what the player can see. Whether each cell lets light through is kept in a
+    NumPy array that's patched a cell at a time when something changes, and the field of view
+    is only recomputed when the player moves or the transparency changes. Nothing further than
+    radius from the player can be seen, so the libtcod map only covers that window around the
+    player. It's kept from one recompute to the next along with a copy of what's in it, changes
+    inside the window are patched straight into it and when the window moves only the cells
+    that differ are set. visible holds the cells in view and explored every cell that has ever
+    been in view, both indexed [x, y] like the Map."""
+    def __init__(self, board, algorithm=FOV_ALGORITHM, radius=FOV_RADIUS, light_walls=FOV_LIGHT_WALLS):
+        self.board = board
+        self.algorithm = algorithm
+        self.radius = radius
+        self.light_walls = light_walls
+
+        self.fov_map = None
+        self.fov_map_size = None
+        #Where the libtcod map's (0, 0) is on the board and the transparency it holds, indexed
+        #[x, y] from there. Cells off the board are kept opaque
+        self.fov_map_origin = None
+        self.fov_map_transparent = None
+        #The cells on the board the libtcod map covered last time, as (min_x, min_y, max_x, max_y)
+        self.window = None
+        self.transparent = numpy.ones((board.width, board.height), dtype=bool)
+        self.visible = numpy.zeros((board.width, board.height), dtype=bool)
+        self.explored = numpy.zeros((board.width, board.height), dtype=bool)
+        self.origin = None
+        self.needs_recompute = True
+
+    def rebuild(self):
+        #Work out the transparency of every cell from the board, called once after each generate
+        self.transparent = ~self.board.map.blocks_light
+        for piece in self.board.pieces:
+            if piece.blocks_light:
+                self.transparent[piece.x, piece.y] = False
+
+        self.visible[:] = False
+        self.explored[:] = False
+        self.window = None
+        #The libtcod map is kept, but everything in it has to be checked against the new floor
+        self.fov_map_origin = None
+        self.needs_recompute = True
+
+    def cell_changed(self, x, y, transparent):
+        #Patch a single cell, nothing needs doing unless its transparency has changed
+        if self.transparent[x, y] == transparent:
+            return
+
+        self.transparent[x, y] = transparent
+        self.needs_recompute = True
+        if self.fov_map_origin is not None:
+            self.patch_fov_map(x, y, x + 1, y + 1)
+
+    def region_changed(self, min_x, min_y, transparent):
+        #Patch a block of cells starting at (min_x, min_y), e.g. when a chunk of the map is carved
+        width, height = transparent.shape
+        self.transparent[min_x:min_x + width, min_y:min_y + height] = transparent
+        self.needs_recompute = True
+        if self.fov_map_origin is not None:
+            self.patch_fov_map(min_x, min_y, min_x + width, min_y + height)
+
+    def patch_fov_map(self, min_x, min_y, max_x, max_y):
+        #Copy the part of a block of board cells that's inside the libtcod map into it, only
+        #setting the cells that differ from what it already holds
+        origin_x, origin_y = self.fov_map_origin
+        width, height = self.fov_map_size
+        min_x = max(min_x, origin_x, 0)
+        min_y = max(min_y, origin_y, 0)
+        max_x = min(max_x, origin_x + width, self.board.width)
+        max_y = min(max_y, origin_y + height, self.board.height)
+        if min_x >= max_x or min_y >= max_y:
+            return
+
+        wanted = self.transparent[min_x:max_x, min_y:max_y]
+        held = self.fov_map_transparent[min_x - origin_x:max_x - origin_x, min_y - origin_y:max_y - origin_y]
+        changed_x, changed_y = numpy.nonzero(wanted != held)
+        for x, y in zip(changed_x.tolist(), changed_y.tolist()):
+            #libtcod's field of view only looks at transparency
+            libtcod.map_set_properties(self.fov_map, min_x - origin_x + x, min_y - origin_y + y, bool(wanted[x, y]), True)
+        held[:] = wanted
+
+    def move_fov_map(self, origin_x, origin_y):
+        #Point the libtcod map at a new window, setting only the cells whose transparency is
+        #different there
+        width, height = self.fov_map_size
+        wanted = numpy.zeros((width, height), dtype=bool)
+        min_x = max(origin_x, 0)
+        min_y = max(origin_y, 0)
+        max_x = min(origin_x + width, self.board.width)
+        max_y = min(origin_y + height, self.board.height)
+        if min_x < max_x and min_y < max_y:
+            wanted[min_x - origin_x:max_x - origin_x, min_y - origin_y:max_y - origin_y] = self.transparent[min_x:max_x, min_y:max_y]
+
+        changed_x, changed_y = numpy.nonzero(wanted != self.fov_map_transparent)
+        for x, y in zip(changed_x.tolist(), changed_y.tolist()):
+            libtcod.map_set_properties(self.fov_map, x, y, bool(wanted[x, y]), True)
+        self.fov_map_transparent = wanted
+        self.fov_map_origin = (origin_x, origin_y)
+
+    def set_algorithm(self, algorithm, radius=None):
+        #Switch to another libtcod FOV algorithm, and radius if it's given, 0 for no limit
+        self.algorithm = algorithm
+        if radius is not None:
+            self.radius = radius
+        self.needs_recompute = True
+
+    def update(self):
+        #Recompute the field of view if the player has moved or the transparency has changed,
+        #returns True if it was recomputed
+        player = self.board.player
+        if not self.needs_recompute and self.origin == (player.x, player.y):
+            return False
+
+        #The libtcod map is always the same size, a square that could just hold the radius,
+        #so it never needs making again as the player moves about
+        if self.radius:
+            origin_x = player.x - self.radius
+            origin_y = player.y - self.radius
+            size = (2 * self.radius + 1, 2 * self.radius + 1)
+        else:
+            origin_x, origin_y = 0, 0
+            size = (self.board.width, self.board.height)
+
+        if self.fov_map_size != size:
+            if self.fov_map is not None:
+                libtcod.map_delete(self.fov_map)
+            self.fov_map = libtcod.map_new(*size)
+            self.fov_map_size = size
+            #A new libtcod map starts out with every cell opaque
+            self.fov_map_transparent = numpy.zeros(size, dtype=bool)
+            self.fov_map_origin = None
+
+        if self.fov_map_origin != (origin_x, origin_y):
+            self.move_fov_map(origin_x, origin_y)
+
+        libtcod.map_compute_fov(self.fov_map, player.x - origin_x, player.y - origin_y, self.radius, self.light_walls, self.algorithm)
+        self.origin = (player.x, player.y)
+        self.needs_recompute = False
+
+        if self.window is not None:
+            old_min_x, old_min_y, old_max_x, old_max_y = self.window
+            self.visible[old_min_x:old_max_x, old_min_y:old_max_y] = False
+
+        #Only the part of the libtcod map that's on the board
+        min_x = max(origin_x, 0)
+        min_y = max(origin_y, 0)
+        max_x = min(origin_x + size[0], self.board.width)
+        max_y = min(origin_y + size[1], self.board.height)
+        self.window = (min_x, min_y, max_x, max_y)
+
+        #libtcod can only be asked a cell at a time. Within a radius the window is small enough to
+        #ask about all of it, with no radius only the cells around what's in view are asked about
+        if self.radius:
+            for x in range(min_x, max_x):
+                for y in range(min_y, max_y):
+                    if libtcod.map_is_in_fov(self.fov_map, x - origin_x, y - origin_y):
+                        self.visible[x, y] = True
+        else:
+            self.follow_light(origin_x, origin_y)
+
+        self.explored[min_x:max_x, min_y:max_y] |= self.visible[min_x:max_x, min_y:max_y]
+        return True
+
+    def follow_light(self, origin_x, origin_y):
+        #Mark what's in view by following the lit cells out from the player. Any cell in view can
+        #be seen along a line of cells that let light through and are in view themselves, so
+        #only the cells next to those ever need asking about
+        player = self.board.player
+        min_x, min_y, max_x, max_y = self.window
+        asked = set([(player.x, player.y)])
+        waiting = [(player.x, player.y)]
+        if libtcod.map_is_in_fov(self.fov_map, player.x - origin_x, player.y - origin_y):
+            self.visible[player.x, player.y] = True
+        while waiting:
+            x, y = waiting.pop()
+            for near_x in range(max(x - 1, min_x), min(x + 2, max_x)):
+                for near_y in range(max(y - 1, min_y), min(y + 2, max_y)):
+                    if (near_x, near_y) in asked:
+                        continue
+                    asked.add((near_x, near_y))
+                    if libtcod.map_is_in_fov(self.fov_map, near_x - origin_x, near_y - origin_y):
+                        self.visible[near_x, near_y] = True
+                        if self.transparent[near_x, near_y]:
+                            waiting.append((near_x, near_y))
@@ -1,46 +1,254 @@
-import libtcodpy as libtcod
 import game_piece
+import batch_ai
+import render
 import textwrap
+import heapq
+import itertools
+import time
+
+#The time an action takes for an actor with a speed of game_piece.NORMAL_SPEED
+ACTION_COST = 100
+
+#Actors are put to sleep when they're outside of the square of regions, ACTIVE_REGION_RADIUS
+#regions either side of the player's. Regions are REGION_SIZE cells square.
+REGION_SIZE = 16
+ACTIVE_REGION_RADIUS = 1
+
+#How far away the sound of a fight wakes dormant actors
+ATTACK_NOISE_RADIUS = 24
+
+class Scheduler(object):
+    """Keeps the actors in a heap ordered by the time of their next turn. After each turn an
+    actor goes back in ACTION_COST * NORMAL_SPEED / speed later, so fast actors get more turns
+    than slow ones. Removing an actor only marks its entry, it's thrown away when it reaches
+    the top of the heap."""
+    def __init__(self):
+        self.heap = []
+        #The live heap entry, [time, order, actor, removed], for each actor
+        self.entries = {}
+        self.order = itertools.count()
+        self.time = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, actor):
+        return actor in self.entries
+
+    def add(self, actor, delay=0):
+        self.add_at(actor, self.time + delay)
+
+    def add_at(self, actor, time):
+        #Schedule an actor's next turn for an exact time, turns at the same time go in the order they were added
+        if actor in self.entries:
+            self.remove(actor)
+
+        entry = [time, next(self.order), actor, False]
+        self.entries[actor] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, actor):
+        entry = self.entries.pop(actor, None)
+        if entry:
+            entry[3] = True
+
+    def clear(self):
+        self.heap = []
+        self.entries = {}
+
+    def peek(self):
+        #The actor whose turn it is, or None if there aren't any
+        while self.heap and self.heap[0][3]:
+            heapq.heappop(self.heap)
+
+        if self.heap:
+            return self.heap[0][2]
+        return None
+
+    def end_turn(self, actor):
+        #Move the clock on to this actor's turn and put them back in for their next one
+        entry = self.entries[actor]
+        self.time = entry[0]
+        self.add(actor, ACTION_COST * game_piece.NORMAL_SPEED / float(actor.speed))
+
+    def pop_batch(self, test):
+        #Take out the actors whose turns are all at the same time as the next one, in turn order,
+        #stopping at the first one that fails test. The clock moves on to their turn.
+        batch = []
+        actor = self.peek()
+        if actor is None:
+            return batch
+
+        time = self.heap[0][0]
+        while actor is not None and self.heap[0][0] == time and test(actor):
+            heapq.heappop(self.heap)
+            del self.entries[actor]
+            batch.append(actor)
+            actor = self.peek()
+
+        self.time = time
+        return batch
+
+    def end_batch(self, batch):
+        #Put a batch from pop_batch back in for their next turns
+        for actor in batch:
+            self.add(actor, ACTION_COST * game_piece.NORMAL_SPEED / float(actor.speed))
 
 class Game():
     """Represents a game with a board and a message system. Is called from the UI
-       to process the next turn."""
-    def __init__(self, message_system, board):
+       to process the next turn.
+       Only actors near the player are scheduled, the rest are kept dormant in buckets keyed
+       by map region until the player comes close or something wakes them.
+       With batch_ai BasicMonsters that take their turns at the same time are moved together
+       by batch_ai.plan_moves instead of one at a time."""
+    def __init__(self, message_system, board, batch_ai=False):
         self.game_state = "playing"
-        self.actors = []
-        self.index = 0
+        self.batch_ai = batch_ai
+        self.scheduler = Scheduler()
+        self.dormant = {}
+        self.player_region = None
         self.message_system = message_system
         self.board = board
         self.board.game = self
 
     def add_actor(self, actor):
-        self.actors.append(actor)
+        if actor is self.board.player:
+            self.scheduler.add(actor)
+            self.wake_around_player()
+        elif self.in_active_region(actor):
+            self.scheduler.add(actor)
+        else:
+            self.sleep(actor)
 
     def remove_actor(self, actor):
-        self.actors.remove(actor)
+        self.scheduler.remove(actor)
+        bucket = self.dormant.get(self.region_of(actor))
+        if bucket:
+            bucket.discard(actor)
+
+    def clear_actors(self):
+        self.scheduler.clear()
+        self.dormant = {}
+        self.player_region = None
+
+    def region_of(self, piece):
+        return (piece.x // REGION_SIZE, piece.y // REGION_SIZE)
+
+    def in_active_region(self, piece):
+        region = self.region_of(piece)
+        player_region = self.region_of(self.board.player)
+        return (abs(region[0] - player_region[0]) <= ACTIVE_REGION_RADIUS and
+                abs(region[1] - player_region[1]) <= ACTIVE_REGION_RADIUS)
+
+    def sleep(self, actor):
+        #Stop scheduling an actor until its region becomes active or it's woken
+        self.scheduler.remove(actor)
+        self.dormant.setdefault(self.region_of(actor), set()).add(actor)
+
+    def wake(self, actor):
+        #Schedule a dormant actor to take a turn now, does nothing if it's awake
+        bucket = self.dormant.get(self.region_of(actor))
+        if bucket and actor in bucket:
+            bucket.remove(actor)
+            self.scheduler.add(actor)
+
+    def wake_region(self, region):
+        bucket = self.dormant.pop(region, None)
+        if bucket:
+            #Sorted so that actors woken together always take their turns in the same order
+            for actor in sorted(bucket, key=lambda actor: (actor.y, actor.x)):
+                self.scheduler.add(actor)
+
+    def wake_around_player(self):
+        #Wake the regions around the player if they've moved into a new one
+        region = self.region_of(self.board.player)
+        if region == self.player_region:
+            return
+
+        self.player_region = region
+        for x in range(region[0] - ACTIVE_REGION_RADIUS, region[0] + ACTIVE_REGION_RADIUS + 1):
+            for y in range(region[1] - ACTIVE_REGION_RADIUS, region[1] + ACTIVE_REGION_RADIUS + 1):
+                self.wake_region((x, y))
+
+    def make_noise(self, x, y, radius):
+        #Wake every dormant actor within radius cells of (x, y)
+        for region_x in range((x - radius) // REGION_SIZE, (x + radius) // REGION_SIZE + 1):
+            for region_y in range((y - radius) // REGION_SIZE, (y + radius) // REGION_SIZE + 1):
+                for actor in list(self.dormant.get((region_x, region_y), ())):
+                    if (actor.x - x) ** 2 + (actor.y - y) ** 2 <= radius ** 2:
+                        self.wake(actor)
+
+    def waiting_for_input(self):
+        #True when nothing can happen until the player chooses an action
+        actor = self.scheduler.peek()
+        if actor is None:
+            return True
+
+        return isinstance(actor.ai, game_piece.PlayerAI) and actor.ai.action is None
 
     def process_turn(self):
-        if len(self.actors) > 0:
-            actor = self.actors[self.index]
+        actor = self.scheduler.peek()
+        if actor is None:
+            return False
 
-            if actor.ai:
-                action = actor.ai.take_turn()
+        if not actor.ai:
+            #Nothing left to take turns for this actor
+            self.scheduler.remove(actor)
+            return False
 
-                if not action:
-                    return False
+        if self.batch_ai and isinstance(actor.ai, game_piece.BasicMonster):
+            return self.process_batch()
 
-                while(True):
-                    result, alternative = action.perform()
-                    if result:
-                        break
-                    elif not alternative:
-                        return False
-                    action = alternative
+        action = actor.ai.take_turn()
 
-                self.index += 1
-                self.index %= len(self.actors)
+        if not action:
+            return False
 
-                return True
+        while(True):
+            result, alternative = action.perform()
+            if result:
+                break
+            elif not alternative:
+                return False
+            action = alternative
+
+        self.scheduler.end_turn(actor)
+
+        if actor is self.board.player:
+            self.wake_around_player()
+        elif not self.in_active_region(actor):
+            self.sleep(actor)
+
+        return True
+
+    def process_batch(self):
+        monsters = self.scheduler.pop_batch(lambda actor: isinstance(actor.ai, game_piece.BasicMonster))
+
+        #A monster that can't make its move waits, just like BasicMonster.take_turn
+        for action in batch_ai.plan_moves(self.board, monsters):
+            action.perform()
+
+        self.scheduler.end_batch(monsters)
+        for monster in monsters:
+            if not self.in_active_region(monster):
+                self.sleep(monster)
+
+        return True
+
+    def process_turns(self, time_budget=None):
+        #Keep processing turns until the player needs to choose an action, so that every monster
+        #moves in the same frame. time_budget is the most seconds to spend before handing back
+        #to the UI, None means no limit. Returns True if any actor took a turn.
+        start = time.time()
+        acted = False
+        while self.process_turn():
+            acted = True
+            if self.waiting_for_input():
+                break
+            if time_budget is not None and time.time() - start >= time_budget:
+                break
+
+        return acted
 
 class Message:
     """Stores and prints a message buffer of a set size"""
@@ -52,14 +260,13 @@ class Message:
     def draw(self, console):
         self.clear(console)
 
-        libtcod.console_set_default_foreground(console, libtcod.white)
         y = 0
         for line in self.buffer:
-            libtcod.console_print_ex(console, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+            render.backend.print_text(console, 0, y, line)
             y += 1
 
     def clear(self, console):
-        libtcod.console_clear(console)
+        render.backend.clear(console)
 
     def add_message(self, message):
         message_lines = textwrap.wrap(message, self.width)
@@ -79,12 +286,15 @@ class StatusBar:
         self.current_spell = current_spell
 
     def draw(self, console):
-        libtcod.console_clear(console)
-        libtcod.console_set_default_foreground(console, libtcod.white)
-        libtcod.console_print_ex(console, 3, 0, libtcod.BKGND_NONE, libtcod.LEFT, 'HP: ' + str(self.player.fighter.hp))
+        render.backend.clear(console)
+
+        hp = 0
+        if self.player.fighter:
+            hp = self.player.fighter.hp
+        render.backend.print_text(console, 3, 0, 'HP: ' + str(hp))
         if self.current_spell:
-            libtcod.console_print_ex(console, 10, 0, libtcod.BKGND_NONE, libtcod.LEFT, self.current_spell.target_function.__name__)
-            libtcod.console_print_ex(console, 30, 0, libtcod.BKGND_NONE, libtcod.LEFT, self.current_spell.effect_function.__name__)
+            render.backend.print_text(console, 10, 0, self.current_spell.target_function.__name__)
+            render.backend.print_text(console, 30, 0, self.current_spell.effect_function.__name__)
 
 class MoveAction(object):
     """The Move Action encodes the movement of a game_piece on the board
@@ -112,8 +322,7 @@ class MoveAction(object):
         result, alternative = self.isValid()
         if result:
             #Move to the destination
-            self.piece.x = self.x
-            self.piece.y = self.y
+            self.piece.board.move_piece(self.piece, self.x, self.y)
 
         return result, alternative
 
@@ -138,5 +347,6 @@ class AttackAction(object):
         return True, None
 
     def perform(self):
+        self.attacker.board.game.make_noise(self.attacker.x, self.attacker.y, ATTACK_NOISE_RADIUS)
         self.defender.fighter.take_damage(self.attacker.fighter.power)
         return True, None
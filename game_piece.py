@@ -2,6 +2,16 @@ import libtcodpy as libtcod
 import math
 import game_engine
 
+#The kinds of terrain a Map cell can hold, a cell's tile id is the index into this list
+TILE_KINDS = ['empty', 'floor', 'wall', 'down_stairs', 'up_stairs']
+EMPTY, FLOOR, WALL, DOWN_STAIRS, UP_STAIRS = range(len(TILE_KINDS))
+
+#The kinds of piece the PieceFactory can make besides tiles
+PIECE_KINDS = ['player', 'orc']
+
+#The speed of a normal actor, one with twice this speed gets two turns for every one of theirs
+NORMAL_SPEED = 100
+
 class Sprite(object):
     """A Sprite represents a colored char that can draw it's self at a given position"""
     def __init__(self, char, color):
@@ -13,12 +23,12 @@ class Sprite(object):
         libtcod.console_set_default_foreground(console, self.color)
         libtcod.console_put_char(console, x, y, self.char, libtcod.BKGND_NONE)
 
-class Piece:
+class Piece(object):
     """this is a generic object: the player, a monster, an item, the stairs...
     it's represented by a character on screen
     it's placed on a particular board object
     it can optionaly have fighter, ai and status components"""
-    def __init__(self, board, x, y, char, color, name, blocks_passage=False, blocks_light=False, fighter=None, ai=None, status=None):
+    def __init__(self, board, x, y, char, color, name, blocks_passage=False, blocks_light=False, fighter=None, ai=None, status=None, speed=NORMAL_SPEED):
         self.board = board
         self.x = x
         self.y = y
@@ -26,6 +36,7 @@ class Piece:
         self.name = name
         self.blocks_passage = blocks_passage
         self.blocks_light = blocks_light
+        self.speed = speed
 
         self.fighter = fighter
         if self.fighter:
@@ -50,34 +61,139 @@ class Piece:
         dy = piece.y - self.y
         return math.sqrt(dx ** 2 + dy ** 2)
 
+class TileType(object):
+    """The shared, immutable prototype for one kind of terrain. Every cell of that kind
+    on the Map reads its sprite and flags from the same TileType."""
+    __slots__ = ('id', 'name', 'sprite', 'blocks_passage', 'blocks_light', 'has_status')
+
+    def __init__(self, id, char, color, name, blocks_passage=False, blocks_light=False, has_status=True):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'sprite', Sprite(char, color))
+        object.__setattr__(self, 'blocks_passage', blocks_passage)
+        object.__setattr__(self, 'blocks_light', blocks_light)
+        object.__setattr__(self, 'has_status', has_status)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TileType is shared between tiles and can't be changed")
+
+class SharedSprite(object):
+    """Stands in for the sprite of a Tile that still shares its TileType's. Reading it reads the
+    prototype, changing it gives the Tile its own copy first."""
+    def __init__(self, tile):
+        object.__setattr__(self, 'tile', tile)
+
+    def __getattr__(self, name):
+        return getattr(self.tile.tile_type.sprite, name)
+
+    def __setattr__(self, name, value):
+        tile = self.tile
+        tile.make_unique()
+        setattr(tile.sprite, name, value)
+        tile.board.map.mark_dirty(tile.x, tile.y)
+
+    def draw(self, console, x, y):
+        self.tile.tile_type.sprite.draw(console, x, y)
+
+class SharedStatus(object):
+    """Stands in for the status of a Tile that still shares its TileType. A shared tile has no
+    status flags set, changing one gives the Tile its own copy first."""
+    def __init__(self, tile):
+        object.__setattr__(self, 'tile', tile)
+
+    def __getattr__(self, name):
+        return getattr(Status.defaults, name)
+
+    def __setattr__(self, name, value):
+        tile = self.tile
+        tile.make_unique()
+        setattr(tile.status, name, value)
+
+class Tile(Piece):
+    """A Piece standing in for one cell of the Map. A Tile starts out sharing everything with
+    its TileType, the first time it's changed it copies the prototype and registers it's self
+    with the Map so that the change sticks. Its sprite and status can be changed in place, so
+    until then they're handed out as SharedSprite and SharedStatus, which only copy when written to."""
+    def __init__(self, board, x, y, tile_type):
+        self.__dict__.update(board=board, x=x, y=y, tile_type=tile_type, unique=False)
+
+    def __getattr__(self, name):
+        #Only called for attributes the Tile hasn't copied from its prototype yet
+        if name == 'sprite':
+            return SharedSprite(self)
+        elif name == 'status':
+            if self.tile_type.has_status:
+                return SharedStatus(self)
+            return None
+        elif name == 'fighter' or name == 'ai':
+            return None
+        elif name in ('name', 'blocks_passage', 'blocks_light'):
+            return getattr(self.tile_type, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.make_unique()
+        self.__dict__[name] = value
+        self.board.map.tile_changed(self.x, self.y)
+
+    def make_unique(self):
+        #Copy on write, give this Tile its own copy of the prototype
+        if self.unique:
+            return
+
+        tile_type = self.tile_type
+        status = None
+        if tile_type.has_status:
+            status = Status()
+            status.owner = self
+
+        self.__dict__.update(name=tile_type.name, sprite=Sprite(tile_type.sprite.char, tile_type.sprite.color),
+                             blocks_passage=tile_type.blocks_passage, blocks_light=tile_type.blocks_light,
+                             fighter=None, ai=None, status=status, unique=True)
+        self.board.map.tile_pieces[(self.x, self.y)] = self
+        #The sprite may now be changed in place so it needs redrawing
+        self.board.map.mark_dirty(self.x, self.y)
+
 class PieceFactory:
     """The PieceFactory takes a string describing the piece it should make, wall, orc etc and then
     returns a Piece with those paramaters."""
+
+    #One prototype for each kind of tile, indexed by tile id and shared by every Map
+    tile_types = [
+        TileType(EMPTY, ' ', libtcod.white, '', has_status=False),
+        TileType(FLOOR, '.', libtcod.white, 'Floor'),
+        TileType(WALL, '#', libtcod.white, 'Wall', blocks_passage=True, blocks_light=True),
+        TileType(DOWN_STAIRS, '>', libtcod.white, 'Down Stairs'),
+        TileType(UP_STAIRS, '<', libtcod.white, 'Up Stairs'),
+    ]
+
     def __init__(self, board):
         self.board = board
 
+    def createTile(self, tile_id, x, y):
+        return Tile(self.board, x, y, self.tile_types[tile_id])
+
     def createPiece(self, identifier, x=0, y=0):
-        if identifier == 'wall':
-            return Piece(self.board, x, y, '#', libtcod.white, 'Wall', blocks_passage=True, blocks_light=True, status=Status())
-        elif identifier == 'floor':
-            return Piece(self.board, x, y, '.', libtcod.white, 'Floor', blocks_passage=False, blocks_light=False, status=Status())
-        elif identifier == 'down_stairs':
-            return Piece(self.board, x, y, '>', libtcod.white, 'Down Stairs', blocks_passage=False, blocks_light=False, status=Status())
-        elif identifier == 'empty':
-            return Piece(self.board, x, y, ' ', libtcod.white, '', blocks_passage=False, blocks_light=False)
+        if identifier in TILE_KINDS:
+            return self.createTile(TILE_KINDS.index(identifier), x, y)
         elif identifier == 'player':
             fighter = Fighter(hp=5, power=1, death_function=player_death)
-            return Piece(self.board, x, y, '@', libtcod.white, "Hero", blocks_passage=True, blocks_light=False, fighter=fighter, ai=PlayerAI(), status=Status())
+            piece = Piece(self.board, x, y, '@', libtcod.white, "Hero", blocks_passage=True, blocks_light=False, fighter=fighter, ai=PlayerAI(), status=Status())
         elif identifier == 'orc':
             fighter = Fighter(hp=1, power=1, death_function=monster_death)
-            return Piece(self.board, x, y, 'o', libtcod.green, "Orc", blocks_passage=True, blocks_light=False, fighter=fighter, ai=BasicMonster(), status=Status())
+            piece = Piece(self.board, x, y, 'o', libtcod.green, "Orc", blocks_passage=True, blocks_light=False, fighter=fighter, ai=BasicMonster(), status=Status())
         else:
             return None
 
+        #Remembered so the piece can be made again when a game is loaded
+        piece.kind = identifier
+        return piece
+
 def monster_death(monster):
     death_message = "The " + monster.name + " dies!"
     monster.board.game.message_system.add_message(death_message)
     monster.blocks_passage = False
+    monster.board.refresh_cell(monster.x, monster.y)
     monster.sprite = Sprite('%', libtcod.red)
     monster.ai = None
     monster.fighter = None
@@ -89,6 +205,7 @@ def player_death(player):
     death_message = "The Hero dies! Game Over!"
     player.board.game.message_system.add_message(death_message)
     player.blocks_passage = False
+    player.board.refresh_cell(player.x, player.y)
     player.sprite = Sprite('@', libtcod.red)
     player.fighter = None
     player.name = "Hero's corpse"
@@ -98,10 +215,14 @@ def player_death(player):
 def wall_destruction(piece):
     piece.blocks_passage = False
     piece.blocks_light = False
+    piece.board.refresh_cell(piece.x, piece.y)
     piece.sprite = Sprite('.', libtcod.white)
     piece.fighter = None
     piece.ai = None
 
+#The death functions a Fighter can have, floor journals and saved games record the index
+DEATH_FUNCTIONS = [None, player_death, monster_death, wall_destruction]
+
 class Fighter:
     """This class contains all the data and methods needed for a piece to fight."""
     def __init__(self, hp, power, death_function=None):
@@ -111,6 +232,9 @@ class Fighter:
         self.death_function = death_function
 
     def take_damage(self, amount):
+        #Being hurt wakes a dormant monster up
+        self.owner.board.game.wake(self.owner)
+
         if self.hp > amount:
             self.hp -= amount
         else:
@@ -122,6 +246,9 @@ class Status:
     def __init__(self):
         self.frozen = False
 
+#The flags of a Status nothing has happened to yet
+Status.defaults = Status()
+
 class PlayerAI:
     """The AI representing the player, stores a buffer with the players"""
     def __init__(self):
@@ -136,26 +263,18 @@ class PlayerAI:
         self.action = action
 
 class BasicMonster:
-    """The AI for a basic monster"""
+    """The AI for a basic monster, it chases the player down the board's flow field"""
     def take_turn(self):
-        player = self.owner.board.player
-        dx = player.x - self.owner.x
-        dy = player.y - self.owner.y
-        distance = math.sqrt(dx ** 2 + dy ** 2)
-
-        x = self.owner.x + int(round(dx / distance))
-        y = self.owner.y + int(round(dy / distance))
-
-        move_action = game_engine.MoveAction(self.owner, x, y)
-        wait_action = game_engine.WaitAction(self.owner)
-
-        if distance < 5:
-            if move_action.isValid()[0]:
-                return move_action
-            else:
-                return wait_action
-        else:
-            return wait_action
+        board = self.owner.board
+
+        if self.owner.distance_to(board.player) < 5:
+            x, y = board.flow.next_step(self.owner.x, self.owner.y)
+            if (x, y) != (self.owner.x, self.owner.y):
+                move_action = game_engine.MoveAction(self.owner, x, y)
+                if move_action.isValid()[0]:
+                    return move_action
+
+        return game_engine.WaitAction(self.owner)
 
 class StatusAffectedMonster:
     """AI code that takes status effects into account"""
@@ -0,0 +1,153 @@
+import libtcodpy as libtcod
+import argparse
+import sys
+import numpy
+import render
+import commands
+import spells
+import savegame
+from dungeon import Board
+from game_engine import Game, Message, StatusBar
+
+MAP_WIDTH = 80
+MAP_HEIGHT = 41
+PANEL_HEIGHT = 7
+
+class MemoryConsole(object):
+    """Stands in for a libtcod console, keeping whatever is drawn on it in NumPy arrays"""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.clear()
+
+    def clear(self):
+        self.chars = numpy.empty((self.height, self.width), dtype=numpy.intc)
+        self.chars.fill(ord(' '))
+        self.fore = numpy.zeros((3, self.height, self.width), dtype=numpy.intc)
+        self.back = numpy.zeros((3, self.height, self.width), dtype=numpy.intc)
+
+    def text(self):
+        return [''.join(chr(char) for char in row) for row in self.chars]
+
+class MemoryBackend(object):
+    """Draws onto MemoryConsoles"""
+    def fill(self, console, chars, fore, back):
+        console.chars[:] = chars
+        console.fore[:] = fore
+        console.back[:] = back
+
+    def clear(self, console):
+        console.clear()
+
+    def print_text(self, console, x, y, text, color=libtcod.white):
+        text = text[:console.width - x]
+        console.chars[y, x:x + len(text)] = [ord(char) for char in text]
+        console.fore[:, y, x:x + len(text)] = numpy.array(tuple(color))[:, numpy.newaxis]
+
+class NullBackend(object):
+    """Throws away everything that's drawn"""
+    def fill(self, console, chars, fore, back):
+        pass
+
+    def clear(self, console):
+        pass
+
+    def print_text(self, console, x, y, text, color=libtcod.white):
+        pass
+
+class Simulation(object):
+    """A whole game without a window: a Board, Game, Message system and StatusBar stepped by
+    commands (see commands.py) instead of key presses. Drawing goes to MemoryConsoles, or
+    nowhere with NullBackend. The map console is at most MAP_WIDTH x MAP_HEIGHT and shows
+    the part of the floor around the player. Given a load_path it carries on with a saved
+    game instead of starting a new one."""
+    def __init__(self, seed=None, width=MAP_WIDTH, height=MAP_HEIGHT, batch_ai=False, backend=None, load_path=None):
+        if backend is None:
+            backend = MemoryBackend()
+        render.set_backend(backend)
+
+        if load_path is None:
+            self.message_system = Message(PANEL_HEIGHT, min(width, MAP_WIDTH))
+            self.board = Board(width, height, seed)
+            self.game = Game(self.message_system, self.board, batch_ai=batch_ai)
+            self.board.generate()
+            self.current_spell = spells.random_spell(self.board.player)
+        else:
+            self.game, self.current_spell = savegame.load(load_path, batch_ai=batch_ai)
+            self.board = self.game.board
+            self.message_system = self.game.message_system
+            width = self.board.width
+            height = self.board.height
+
+        self.status_bar = StatusBar(self.board.player, self.current_spell)
+
+        view_width = min(width, MAP_WIDTH)
+        view_height = min(height, MAP_HEIGHT)
+        self.board.renderer.camera.resize(view_width, view_height)
+        self.con = MemoryConsole(view_width, view_height)
+        self.panel = MemoryConsole(view_width, PANEL_HEIGHT)
+        self.status_panel = MemoryConsole(view_width, 1)
+
+    def step(self, command):
+        #Carry out one command then let everyone else take their turns,
+        #returns False if the command couldn't be carried out
+        performed = commands.perform(self.board, command, self.current_spell)
+        self.game.process_turns()
+        return performed
+
+    def run(self, script):
+        #Step through a list of commands, stopping early if the game ends
+        for command in script:
+            if self.game.game_state != "playing":
+                break
+            self.step(command)
+
+    def save(self, path):
+        savegame.save(path, self.board, self.current_spell)
+
+    def draw(self):
+        self.board.draw(self.con)
+        self.message_system.draw(self.panel)
+        self.status_bar.draw(self.status_panel)
+
+    def screen(self):
+        #The text of the whole screen, laid out like main.py does
+        self.draw()
+        return self.con.text() + self.status_panel.text() + self.panel.text()
+
+def read_script(lines):
+    #One command per line, blank lines and lines starting with # are skipped
+    script = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            script.append(line)
+    return script
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run Forgetful Wizard without a window from a script of commands.")
+    parser.add_argument('script', nargs='?', help="file with one command per line, read from stdin if not given")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--width', type=int, default=MAP_WIDTH)
+    parser.add_argument('--height', type=int, default=MAP_HEIGHT)
+    parser.add_argument('--batch-ai', action='store_true')
+    parser.add_argument('--load', help="carry on with a saved game instead of starting a new one")
+    parser.add_argument('--save', help="save the game here once the script has run")
+    args = parser.parse_args(argv)
+
+    if args.script:
+        with open(args.script) as script_file:
+            script = read_script(script_file)
+    else:
+        script = read_script(sys.stdin)
+
+    simulation = Simulation(args.seed, args.width, args.height, batch_ai=args.batch_ai, load_path=args.load)
+    simulation.run(script)
+    if args.save:
+        simulation.save(args.save)
+
+    for line in simulation.screen():
+        print(line.rstrip())
+
+if __name__ == '__main__':
+    main()
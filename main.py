@@ -1,13 +1,29 @@
 import libtcodpy as libtcod
 from dungeon import *
 import spells
+import commands
+import floor_pool
 
 SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
 LIMIT_FPS = 60
+#The most seconds of monster turns to process in one frame, None to always finish them all
+TURN_TIME_BUDGET = None
+#Move all of the basic monsters together with NumPy rather than one at a time
+BATCH_AI = False
+#Seed for the dungeon's random number generators, None to pick a new one each game
+SEED = None
+#Generate the next floor in a background process while the current one is played
+PREGENERATE_FLOORS = True
+#How the player's field of view is worked out, and how far they can see, 0 for no limit
+FOV_ALGORITHM = libtcod.FOV_RESTRICTIVE
+FOV_RADIUS = 10
 
 MAP_WIDTH = 80
 MAP_HEIGHT = 41
+#The size of each floor, the map console shows the part of it around the player
+FLOOR_WIDTH = 160
+FLOOR_HEIGHT = 82
 
 PANEL_HEIGHT = 7
 PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT - 1
@@ -24,7 +40,7 @@ def menu(header, options, width):
 		raise ValueError("Can't have a menu with more than 26 options.")
 
 	#Calculate the word wrapped height of the header and the total window height
-	header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+	header_height = libtcod.console_get_height_rect(0, 0, 0, width, SCREEN_HEIGHT, header)
 	height = len(options) + header_height
 
 	#Create a new window for the menu
@@ -48,16 +64,7 @@ def menu(header, options, width):
 	y = SCREEN_HEIGHT/2 - height/2
 	libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
 
-def handle_keys(board, current_spell):
-	game_state = board.game.game_state
-	player = board.player
-
-	# key = libtcod.console_check_for_keypress()
-
-	key = libtcod.Key()
-	mouse = libtcod.Mouse()
-	libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS, key, mouse)
-
+def handle_keys(board, current_spell, key):
 	if key.vk == libtcod.KEY_ENTER and key.lalt:
 		#Alt+Enter: toggle fullscreen
 		libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
@@ -67,75 +74,114 @@ def handle_keys(board, current_spell):
 	if not key.pressed:
 		return
 
-	if (game_state == "playing"):
-		if key.vk == libtcod.KEY_UP or key.vk == libtcod.KEY_KP8 or key.c == ord('k'):
-			player.ai.set_action(MoveAction(player, player.x, player.y - 1))
-		elif key.vk == libtcod.KEY_DOWN or key.vk == libtcod.KEY_KP2 or key.c == ord('j'):
-			player.ai.set_action(MoveAction(player, player.x, player.y + 1))
-		elif key.vk == libtcod.KEY_LEFT or key.vk == libtcod.KEY_KP4 or key.c == ord('h'):
-			player.ai.set_action(MoveAction(player, player.x - 1, player.y))
-		elif key.vk == libtcod.KEY_RIGHT or key.vk == libtcod.KEY_KP6 or key.c == ord('l'):
-			player.ai.set_action(MoveAction(player, player.x + 1, player.y))
-		elif key.c == ord('y') or key.vk == libtcod.KEY_KP7:
-			player.ai.set_action(MoveAction(player, player.x - 1, player.y - 1))
-		elif key.c == ord('u') or key.vk == libtcod.KEY_KP9:
-			player.ai.set_action(MoveAction(player, player.x + 1, player.y - 1))
-		elif key.c == ord('b') or key.vk == libtcod.KEY_KP1:
-			player.ai.set_action(MoveAction(player, player.x - 1, player.y + 1))
-		elif key.c == ord('n') or key.vk == libtcod.KEY_KP3:
-			player.ai.set_action(MoveAction(player, player.x + 1, player.y + 1))
-		elif key.c == ord('.') and key.shift:
-			if board.map.tiles[player.x][player.y].sprite.char == '>':
-				board.generate()
-		elif key.c == ord('.') or key.vk == libtcod.KEY_KP5:
-			#Wait in one place
-			player.ai.set_action(WaitAction(player))
-		elif key.c == ord('z'):
-			zap = spells.Spell(board.player, spells.burst_target, spells.freeze, max_range=5)
-			zap.cast()
-		elif key.c == ord('x'):
-			current_spell.cast()
-			current_spell.target_function = spells.random_target()
-			current_spell.effect_function = spells.random_effect()
-
-
-libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False)
-
-libtcod.sys_set_fps(LIMIT_FPS)
-
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-libtcod.console_set_default_background(panel, libtcod.black)
-
-message_system = Message(PANEL_HEIGHT, SCREEN_WIDTH)
-message_system.add_message("Welcome to Forgetfull Wizard!")
-
-board = Board(MAP_WIDTH, MAP_HEIGHT)
-
-game = Game(message_system, board)
-
-board.generate()
-
-status_panel = libtcod.console_new(SCREEN_WIDTH, 1)
-libtcod.console_set_default_background(status_panel, libtcod.black)
-
-current_spell = spells.random_spell(board.player)
-status_bar = StatusBar(board.player, current_spell)
-
-while not libtcod.console_is_window_closed():
-	player_action = handle_keys(board, current_spell)
-	if player_action == "exit":
-		break
-
-	render = game.process_turn()
-
-	board.draw(con)
-	message_system.draw(panel)
-	status_bar.draw(status_panel)
-
-	libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
-	libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
-	libtcod.console_blit(status_panel, 0, 0, SCREEN_WIDTH, 1, 0, 0, PANEL_Y-1)
-	libtcod.console_flush()
+	command = key_command(key)
+	if command:
+		commands.perform(board, command, current_spell)
+
+def key_command(key):
+	#Turn a key press into one of the commands in commands.py
+	if key.vk == libtcod.KEY_UP or key.vk == libtcod.KEY_KP8 or key.c == ord('k'):
+		return 'up'
+	elif key.vk == libtcod.KEY_DOWN or key.vk == libtcod.KEY_KP2 or key.c == ord('j'):
+		return 'down'
+	elif key.vk == libtcod.KEY_LEFT or key.vk == libtcod.KEY_KP4 or key.c == ord('h'):
+		return 'left'
+	elif key.vk == libtcod.KEY_RIGHT or key.vk == libtcod.KEY_KP6 or key.c == ord('l'):
+		return 'right'
+	elif key.c == ord('y') or key.vk == libtcod.KEY_KP7:
+		return 'up_left'
+	elif key.c == ord('u') or key.vk == libtcod.KEY_KP9:
+		return 'up_right'
+	elif key.c == ord('b') or key.vk == libtcod.KEY_KP1:
+		return 'down_left'
+	elif key.c == ord('n') or key.vk == libtcod.KEY_KP3:
+		return 'down_right'
+	elif key.c == ord('.') and key.shift:
+		return 'descend'
+	elif key.c == ord(',') and key.shift:
+		return 'ascend'
+	elif key.c == ord('.') or key.vk == libtcod.KEY_KP5:
+		return 'wait'
+	elif key.c == ord('z'):
+		return 'zap'
+	elif key.c == ord('x'):
+		return 'cast'
+	return None
+
+def main():
+	#Start the worker before the window so it doesn't inherit it, floors this size are never
+	#big enough to start the part processes later on
+	floor_generator = None
+	if PREGENERATE_FLOORS:
+		floor_generator = floor_pool.FloorGenerator()
+
+	libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+	libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False)
+
+	libtcod.sys_set_fps(LIMIT_FPS)
+
+	con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+
+	panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	libtcod.console_set_default_background(panel, libtcod.black)
+
+	message_system = Message(PANEL_HEIGHT, SCREEN_WIDTH)
+	message_system.add_message("Welcome to Forgetfull Wizard!")
+
+	board = Board(FLOOR_WIDTH, FLOOR_HEIGHT, SEED, FOV_ALGORITHM, FOV_RADIUS)
+	board.floor_generator = floor_generator
+	board.renderer.camera.resize(MAP_WIDTH, MAP_HEIGHT)
+
+	game = Game(message_system, board, batch_ai=BATCH_AI)
+
+	board.generate()
+
+	status_panel = libtcod.console_new(SCREEN_WIDTH, 1)
+	libtcod.console_set_default_background(status_panel, libtcod.black)
+
+	current_spell = spells.random_spell(board.player)
+	status_bar = StatusBar(board.player, current_spell)
+
+	def render_all():
+		board.draw(con)
+		message_system.draw(panel)
+		status_bar.draw(status_panel)
+
+		libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+		libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+		libtcod.console_blit(status_panel, 0, 0, SCREEN_WIDTH, 1, 0, 0, PANEL_Y-1)
+		libtcod.console_flush()
+
+	redraw = True
+
+	while not libtcod.console_is_window_closed():
+		key = libtcod.Key()
+		mouse = libtcod.Mouse()
+		if game.waiting_for_input():
+			#Nothing can change until the player presses a key, so draw and then sleep until they do
+			if redraw:
+				render_all()
+				redraw = False
+			libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS, key, mouse, False)
+		else:
+			libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS, key, mouse)
+
+		player_action = handle_keys(board, current_spell, key)
+		if player_action == "exit":
+			break
+		elif key.pressed:
+			#Spells and stairs change the board without taking a turn
+			redraw = True
+
+		if game.process_turns(TURN_TIME_BUDGET):
+			redraw = True
+
+		if redraw:
+			render_all()
+			redraw = False
+
+	if floor_generator is not None:
+		floor_generator.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,84 @@
+import numpy
+
+#Distance given to cells that can't reach the target
+UNREACHABLE = numpy.iinfo(numpy.int32).max
+#How far the flow field reaches from the player, monsters further away than this don't chase them
+FLOW_RADIUS = 16
+
+class FlowField(object):
+    """The number of steps from the cells around the player to the player, shared by every
+    monster chasing them. It's worked out with a breadth first search over the window of cells
+    within FLOW_RADIUS of the player at most once per player move, after that each monster
+    finds its next step by looking at the 3x3 cells around it. Paths that would leave the
+    window aren't found. Only tiles are taken into account so that monsters queue up behind
+    each other rather than all taking the long way round."""
+    def __init__(self, board):
+        self.board = board
+        #The window, padded by one cell of UNREACHABLE on every side so the 3x3 around any cell
+        #in it can be sliced out. origin is the board cell at distance[0, 0].
+        self.distance = None
+        self.origin = None
+        self.target = None
+        self.map = None
+        self.map_version = None
+
+    def update(self):
+        #Recompute the distances if the player has moved or the map has changed
+        player = self.board.player
+        tile_map = self.board.map
+        if self.target == (player.x, player.y) and self.map is tile_map and self.map_version == tile_map.version:
+            return False
+
+        min_x = max(player.x - FLOW_RADIUS, 0)
+        min_y = max(player.y - FLOW_RADIUS, 0)
+        max_x = min(player.x + FLOW_RADIUS + 1, tile_map.width)
+        max_y = min(player.y + FLOW_RADIUS + 1, tile_map.height)
+        walkable = numpy.zeros((max_x - min_x + 2, max_y - min_y + 2), dtype=bool)
+        walkable[1:-1, 1:-1] = ~tile_map.blocks_passage[min_x:max_x, min_y:max_y]
+        origin_x = min_x - 1
+        origin_y = min_y - 1
+
+        distance = numpy.empty(walkable.shape, dtype=numpy.int32)
+        distance.fill(UNREACHABLE)
+        frontier = numpy.zeros(walkable.shape, dtype=bool)
+        frontier[player.x - origin_x, player.y - origin_y] = True
+        distance[frontier] = 0
+        reached = frontier.copy()
+
+        #Grow the frontier by one step in all eight directions at a time
+        steps = 0
+        while frontier.any():
+            steps += 1
+            grown = frontier.copy()
+            grown[1:, :] |= frontier[:-1, :]
+            grown[:-1, :] |= frontier[1:, :]
+            grown[:, 1:] |= grown[:, :-1].copy()
+            grown[:, :-1] |= grown[:, 1:].copy()
+
+            frontier = grown & walkable & ~reached
+            distance[frontier] = steps
+            reached |= frontier
+
+        self.distance = distance
+        self.origin = (origin_x, origin_y)
+        self.target = (player.x, player.y)
+        self.map = tile_map
+        self.map_version = tile_map.version
+        return True
+
+    def next_step(self, x, y):
+        #The unblocked neighbouring cell closest to the target, or (x, y) if there's no better place to be
+        self.update()
+        i = x - self.origin[0]
+        j = y - self.origin[1]
+        width, height = self.distance.shape
+        if not (1 <= i < width - 1 and 1 <= j < height - 1):
+            return x, y
+
+        around = self.distance[i - 1:i + 2, j - 1:j + 2].copy()
+        around[self.board.blocked_around(x, y)] = UNREACHABLE
+
+        dx, dy = numpy.unravel_index(numpy.argmin(around), around.shape)
+        if around[dx, dy] >= self.distance[i, j]:
+            return x, y
+        return x + int(dx) - 1, y + int(dy) - 1
@@ -0,0 +1,155 @@
+import libtcodpy as libtcod
+import numpy
+
+class LibtcodBackend(object):
+    """Draws onto real libtcod consoles"""
+    def fill(self, console, chars, fore, back):
+        #chars is (height, width), fore and back are (3, height, width)
+        libtcod.console_fill_char(console, chars.ravel())
+        libtcod.console_fill_foreground(console, fore[0].ravel(), fore[1].ravel(), fore[2].ravel())
+        libtcod.console_fill_background(console, back[0].ravel(), back[1].ravel(), back[2].ravel())
+
+    def clear(self, console):
+        libtcod.console_clear(console)
+
+    def print_text(self, console, x, y, text, color=libtcod.white):
+        libtcod.console_set_default_foreground(console, color)
+        libtcod.console_print_ex(console, x, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
+
+#Everything that draws goes through the backend, headless.py swaps it out to run without a window
+backend = LibtcodBackend()
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend
+
+class Camera(object):
+    """The part of the board that's drawn, width by height cells with its top left corner on
+    the board cell (x, y). It keeps the player in the middle without going past the board's edges."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.x = 0
+        self.y = 0
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+
+    def follow(self, piece, board_width, board_height):
+        self.x = max(min(piece.x - self.width // 2, board_width - self.width), 0)
+        self.y = max(min(piece.y - self.height // 2, board_height - self.height), 0)
+
+    def bounds(self, board_width, board_height):
+        #The board cells in view as (min_x, min_y, max_x, max_y), smaller than the camera
+        #if the board is
+        return (self.x, self.y, min(self.x + self.width, board_width), min(self.y + self.height, board_height))
+
+class Renderer(object):
+    """Draws the part of a Board the camera can see by building the char, foreground and
+    background layers as NumPy arrays and pushing each layer to the console in one call.
+    The map's layers for the view are kept between frames and only the cells the Map has
+    marked dirty are updated, they're built again when the camera moves. Cells the player has
+    seen but can't see now are drawn darker, and pieces are only drawn when they are in view.
+    The console must be the same size as the camera, which starts out the size of the Board."""
+    def __init__(self, board):
+        self.board = board
+        self.background = libtcod.black
+
+        #Look up tables from tile id to char and color. The layers are all C ints since that's
+        #what libtcod's console fills read, a wider type would be read as the wrong cells
+        tile_types = self.board.map.tile_types
+        self.type_chars = numpy.array([ord(tile_type.sprite.char) for tile_type in tile_types], dtype=numpy.intc)
+        self.type_colors = numpy.array([tuple(tile_type.sprite.color) for tile_type in tile_types], dtype=numpy.intc).T
+
+        self.camera = Camera(board.width, board.height)
+        #The board cells the map's layers were built for, see Camera.bounds
+        self.view = None
+        self.map_chars = None
+        self.map_fore = None
+        self.back = None
+
+    def draw(self, console):
+        board = self.board
+        tile_map = board.map
+        camera = self.camera
+        camera.follow(board.player, board.width, board.height)
+        view = camera.bounds(board.width, board.height)
+        if (tile_map.redraw_all or view != self.view or self.map_chars is None
+                or self.map_chars.shape != (camera.height, camera.width)):
+            self.rebuild_map(view)
+        else:
+            for x, y in tile_map.dirty:
+                self.update_cell(x, y)
+        tile_map.dirty.clear()
+
+        field_of_view = board.fov
+        field_of_view.update()
+
+        #Cells of the console past the edge of the board count as unexplored
+        min_x, min_y, max_x, max_y = view
+        visible = numpy.zeros((camera.height, camera.width), dtype=bool)
+        explored = numpy.zeros((camera.height, camera.width), dtype=bool)
+        visible[:max_y - min_y, :max_x - min_x] = field_of_view.visible[min_x:max_x, min_y:max_y].T
+        explored[:max_y - min_y, :max_x - min_x] = field_of_view.explored[min_x:max_x, min_y:max_y].T
+
+        #Draw the pieces over a copy of the map's layers
+        chars = self.map_chars.copy()
+        fore = self.map_fore.copy()
+        fore[:, ~visible] //= 2
+        chars[~explored] = ord(' ')
+        self.draw_pieces(chars, fore, visible)
+
+        backend.fill(console, chars, fore, self.back)
+
+    def rebuild_map(self, view):
+        tile_map = self.board.map
+        camera = self.camera
+        min_x, min_y, max_x, max_y = view
+        self.view = view
+
+        #The Map is indexed [x, y] and the console [y, x]
+        tile_ids = tile_map.tile_ids[min_x:max_x, min_y:max_y].T
+        self.map_chars = numpy.empty((camera.height, camera.width), dtype=numpy.intc)
+        self.map_chars.fill(ord(' '))
+        self.map_fore = numpy.zeros((3, camera.height, camera.width), dtype=numpy.intc)
+        self.map_chars[:max_y - min_y, :max_x - min_x] = self.type_chars[tile_ids]
+        self.map_fore[:, :max_y - min_y, :max_x - min_x] = self.type_colors[:, tile_ids]
+
+        #Tiles that have their own sprite
+        for (x, y) in tile_map.tile_pieces:
+            self.update_cell(x, y)
+
+        if self.back is None or self.back.shape != (3, camera.height, camera.width):
+            self.back = numpy.empty((3, camera.height, camera.width), dtype=numpy.intc)
+            self.back[:] = numpy.array(tuple(self.background), dtype=numpy.intc)[:, numpy.newaxis, numpy.newaxis]
+
+        tile_map.redraw_all = False
+
+    def update_cell(self, x, y):
+        #Cells out of view are picked up when the camera gets to them
+        min_x, min_y, max_x, max_y = self.view
+        if not (min_x <= x < max_x and min_y <= y < max_y):
+            return
+        sprite = self.board.map.sprite_at(x, y)
+        self.map_chars[y - min_y, x - min_x] = ord(sprite.char)
+        self.map_fore[:, y - min_y, x - min_x] = tuple(sprite.color)
+
+    def draw_pieces(self, chars, fore, visible):
+        #Look up the cells in view rather than going through every piece on the board. Each cell
+        #keeps its pieces in drawing order, so the last one is drawn over the rest.
+        min_x, min_y = self.view[:2]
+        piece_index = self.board.piece_index
+        pieces = []
+        ys, xs = numpy.nonzero(visible)
+        for y, x in zip(ys.tolist(), xs.tolist()):
+            cell = piece_index.get((x + min_x, y + min_y))
+            if cell:
+                pieces.append(cell[-1])
+        if not pieces:
+            return
+
+        xs = numpy.array([piece.x - min_x for piece in pieces], dtype=numpy.int_)
+        ys = numpy.array([piece.y - min_y for piece in pieces], dtype=numpy.int_)
+        chars[ys, xs] = [ord(piece.sprite.char) for piece in pieces]
+        fore[:, ys, xs] = numpy.array([tuple(piece.sprite.color) for piece in pieces], dtype=numpy.intc).T
@@ -0,0 +1,261 @@
+import json
+import os
+import struct
+import numpy
+import spells
+import floor_cache
+from dungeon import Board, Map
+from game_engine import Game, Message
+from game_piece import PIECE_KINDS
+
+#A saved game starts with MAGIC, the format version and the length of a JSON header, the arrays
+#follow as raw bytes at the offsets the header gives. Bump SAVE_VERSION whenever the layout changes.
+MAGIC = 'FWSAVE\x00\x00'
+SAVE_VERSION = 5
+#Arrays start on a multiple of this many bytes so they can be memory mapped straight into NumPy
+ALIGNMENT = 64
+
+#Flags in a piece table row
+BLOCKS_PASSAGE = 1
+BLOCKS_LIGHT = 2
+FROZEN = 4
+HAS_FIGHTER = 8
+
+#One row of a packed piece table, used for pieces and for tiles that have been changed. kind is an
+#index into PIECE_KINDS for pieces and the tile id for tiles, index is the order a piece was
+#generated in or -1 and death an index into game_piece.DEATH_FUNCTIONS. Names don't fit in a fixed
+#size row so they're kept in the header.
+PIECE_DTYPE = numpy.dtype([('x', '<i2'), ('y', '<i2'), ('kind', 'u1'), ('index', '<i4'), ('char', 'u1'), ('color', 'u1', (3,)),
+                           ('flags', 'u1'), ('max_hp', '<i2'), ('hp', '<i2'), ('power', '<i2'), ('death', 'u1')])
+
+#The names dtypes go by in the header besides NumPy's own
+DTYPES = {'piece': PIECE_DTYPE}
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def pack_rows(rows):
+    #Pack (x, y, kind, index, state) rows, state as made by floor_cache.piece_state,
+    #into a piece table and a list of names
+    table = numpy.zeros(len(rows), dtype=PIECE_DTYPE)
+    names = []
+    for i, (x, y, kind, index, state) in enumerate(rows):
+        name, char, color, blocks_passage, blocks_light, frozen, fighter = state
+        flags = 0
+        if blocks_passage:
+            flags |= BLOCKS_PASSAGE
+        if blocks_light:
+            flags |= BLOCKS_LIGHT
+        if frozen:
+            flags |= FROZEN
+
+        max_hp = hp = power = death = 0
+        if fighter is not None:
+            flags |= HAS_FIGHTER
+            max_hp, hp, power, death = fighter
+
+        table[i] = (x, y, kind, index, ord(char), color, flags, max_hp, hp, power, death)
+        names.append(name)
+    return table, names
+
+def unpack_rows(table, names):
+    rows = []
+    for row, name in zip(table.tolist(), names):
+        x, y, kind, index, char, color, flags, max_hp, hp, power, death = row
+        fighter = None
+        if flags & HAS_FIGHTER:
+            fighter = (max_hp, hp, power, death)
+        state = (str(name), chr(char), tuple(color), bool(flags & BLOCKS_PASSAGE), bool(flags & BLOCKS_LIGHT), bool(flags & FROZEN), fighter)
+        rows.append((x, y, kind, index, state))
+    return rows
+
+def save(path, board, current_spell):
+    """Saves the game on board, with its message system and the current spell, to path.
+    The current floor's tile layers, its plan and which of its chunks have been carved are
+    written as raw arrays and its pieces and changed tiles as packed piece tables. Floors the
+    player has left are saved as FloorJournals."""
+    tile_map = board.map
+    message_system = board.game.message_system
+    arrays = []
+
+    header = {
+        'width': board.width,
+        'height': board.height,
+        'depth': board.depth,
+        'floor_seed': board.floor_seed,
+        'next_floor_seed': board.next_floor_seed,
+        'random_seed': board.random_seed,
+        'fov': [board.fov.algorithm, board.fov.radius],
+        'game_state': board.game.game_state,
+        'messages': {'size': message_system.buffer_max_size, 'width': message_system.width, 'buffer': message_system.buffer},
+        'spell': None,
+        'journals': [],
+        'arrays': {},
+    }
+    if current_spell:
+        header['spell'] = {'target': current_spell.target_function.__name__, 'effect': current_spell.effect_function.__name__,
+                           'kwargs': current_spell.kwargs}
+
+    #The libtcod generator is started again from the floor seed before it's used so it isn't saved
+    version, internal, gauss = board.random.getstate()
+    header['random'] = [version, internal, gauss]
+    version, internal, gauss = board.floor_seeds.getstate()
+    header['floor_seeds'] = [version, internal, gauss]
+    name, keys, position, has_gauss, cached_gaussian = board.numpy_random.get_state()
+    header['numpy_random'] = [name, position, has_gauss, cached_gaussian]
+    arrays.append(('numpy_random_keys', keys))
+
+    arrays.append(('tile_ids', tile_map.tile_ids))
+    arrays.append(('blocks_passage', tile_map.blocks_passage))
+    arrays.append(('blocks_light', tile_map.blocks_light))
+    arrays.append(('plan', tile_map.plan))
+    arrays.append(('carved', tile_map.carved))
+    arrays.append(('explored', board.fov.explored))
+
+    tile_rows = [(x, y, tile_map.tile_ids[x, y], -1, floor_cache.piece_state(tile)) for (x, y), tile in sorted(tile_map.tile_pieces.items())]
+    tiles, header['tile_names'] = pack_rows(tile_rows)
+    arrays.append(('tiles', tiles))
+
+    generated_index = dict((id(piece), i) for i, piece in enumerate(board.generated_pieces))
+    piece_rows = [(piece.x, piece.y, PIECE_KINDS.index(piece.kind), generated_index.get(id(piece), -1), floor_cache.piece_state(piece))
+                  for piece in board.pieces]
+    pieces, header['piece_names'] = pack_rows(piece_rows)
+    arrays.append(('pieces', pieces))
+
+    #Actors are saved by where they are in board.pieces
+    piece_order = dict((id(piece), i) for i, piece in enumerate(board.pieces))
+    scheduler = board.game.scheduler
+    entries = sorted(scheduler.entries.values(), key=lambda entry: entry[1])
+    dormant = [piece_order[id(actor)] for bucket in board.game.dormant.values() for actor in bucket]
+    header['scheduler'] = {'time': scheduler.time, 'entries': [[entry[0], piece_order[id(entry[2])]] for entry in entries],
+                           'dormant': sorted(dormant), 'player_region': board.game.player_region}
+
+    journals = [floor_cache.journal_floor(floor) for floor in board.floor_cache.floors.values()]
+    journals.extend(board.floor_cache.journals.values())
+    for journal in sorted(journals, key=lambda journal: journal.depth):
+        prefix = 'journal%d_' % journal.depth
+        tiles, tile_names = pack_rows([(x, y, 0, -1, state) for x, y, state in journal.tiles])
+        pieces, piece_names = pack_rows([(x, y, 0, index, state) for index, x, y, state in journal.pieces])
+        arrays.append((prefix + 'tiles', tiles))
+        arrays.append((prefix + 'pieces', pieces))
+        arrays.append((prefix + 'explored', journal.explored))
+        header['journals'].append({'depth': journal.depth, 'seed': journal.seed, 'shape': journal.shape,
+                                   'tile_names': tile_names, 'piece_names': piece_names})
+
+    offset = 0
+    for name, array in arrays:
+        dtype_name = 'piece' if array.dtype == PIECE_DTYPE else array.dtype.str
+        header['arrays'][name] = [offset, dtype_name, array.shape]
+        offset += align(array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    #Written next to the old save and moved over it, a loaded game may still have the old one memory mapped
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as save_file:
+        save_file.write(MAGIC)
+        save_file.write(struct.pack('<II', SAVE_VERSION, len(header_bytes)))
+        save_file.write(header_bytes)
+        data_start = align(save_file.tell())
+        for name, array in arrays:
+            save_file.seek(data_start + header['arrays'][name][0])
+            save_file.write(numpy.ascontiguousarray(array).tobytes())
+
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+def load(path, batch_ai=False):
+    """Loads a game saved by save, returns its Game and the current spell. The tile layers are
+    memory mapped copy on write, so nothing is read until it's used and no Tiles are made
+    except for the cells that had been changed."""
+    with open(path, 'rb') as save_file:
+        if save_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " isn't a saved game.")
+        version, header_length = struct.unpack('<II', save_file.read(8))
+        if version != SAVE_VERSION:
+            raise ValueError("Can't load a version %d saved game, expected version %d." % (version, SAVE_VERSION))
+        header = json.loads(save_file.read(header_length).decode('utf-8'))
+    data_start = align(len(MAGIC) + 8 + header_length)
+
+    def read_array(name):
+        offset, dtype_name, shape = header['arrays'][name]
+        dtype = DTYPES.get(dtype_name) or numpy.dtype(str(dtype_name))
+        shape = tuple(shape)
+        if numpy.prod(shape) == 0:
+            return numpy.zeros(shape, dtype=dtype)
+        #Changes made during play stay in memory and never reach the file
+        return numpy.memmap(path, dtype=dtype, mode='c', offset=data_start + offset, shape=shape)
+
+    messages = header['messages']
+    message_system = Message(messages['size'], messages['width'])
+    message_system.buffer = [str(line) for line in messages['buffer']]
+
+    width = header['width']
+    height = header['height']
+    fov_algorithm, fov_radius = header['fov']
+    board = Board(width, height, header['random_seed'], fov_algorithm, fov_radius)
+    game = Game(message_system, board, batch_ai=batch_ai)
+    game.game_state = str(header['game_state'])
+
+    version, internal, gauss = header['random']
+    board.random.setstate((version, tuple(internal), gauss))
+    version, internal, gauss = header['floor_seeds']
+    board.floor_seeds.setstate((version, tuple(internal), gauss))
+    name, position, has_gauss, cached_gaussian = header['numpy_random']
+    board.numpy_random.set_state((str(name), numpy.array(read_array('numpy_random_keys')), position, has_gauss, cached_gaussian))
+    board.depth = header['depth']
+    board.floor_seed = header['floor_seed']
+    board.next_floor_seed = header['next_floor_seed']
+
+    board.map = Map(board, width, height)
+    board.map.set_layers(read_array('tile_ids'), read_array('blocks_passage'), read_array('blocks_light'))
+    board.map.set_plan(read_array('plan'), read_array('carved'))
+    for x, y, kind, index, state in unpack_rows(read_array('tiles'), header['tile_names']):
+        floor_cache.restore_piece_state(board.map.tile_at(x, y), state)
+
+    pieces = []
+    generated = {}
+    for x, y, kind, index, state in unpack_rows(read_array('pieces'), header['piece_names']):
+        if PIECE_KINDS[kind] == 'player':
+            #The player keeps their AI even once they're dead
+            piece = board.player
+            ai = piece.ai
+            floor_cache.restore_piece_state(piece, state)
+            piece.ai = ai
+        else:
+            piece = board.factory.createPiece(PIECE_KINDS[kind])
+            floor_cache.restore_piece_state(piece, state)
+        pieces.append(piece)
+        piece.x = x
+        piece.y = y
+        if index >= 0:
+            generated[index] = piece
+    board.generated_pieces = [generated[i] for i in sorted(generated)]
+    board.place_pieces(pieces, board.player.x, board.player.y)
+    board.fov.explored[:] = read_array('explored')
+
+    #Put everyone back into the turn order as it was
+    game.clear_actors()
+    scheduler = header['scheduler']
+    game.scheduler.time = scheduler['time']
+    for time, i in scheduler['entries']:
+        game.scheduler.add_at(pieces[i], time)
+    for i in scheduler['dormant']:
+        game.sleep(pieces[i])
+    if scheduler['player_region'] is not None:
+        game.player_region = tuple(scheduler['player_region'])
+
+    for journal in header['journals']:
+        prefix = 'journal%d_' % journal['depth']
+        tiles = [(x, y, state) for x, y, kind, index, state in unpack_rows(read_array(prefix + 'tiles'), journal['tile_names'])]
+        pieces = [(index, x, y, state) for x, y, kind, index, state in unpack_rows(read_array(prefix + 'pieces'), journal['piece_names'])]
+        board.floor_cache.journals[journal['depth']] = floor_cache.FloorJournal(
+            journal['depth'], journal['seed'], tiles, pieces, tuple(journal['shape']), numpy.array(read_array(prefix + 'explored')))
+
+    current_spell = None
+    if header['spell']:
+        spell = header['spell']
+        kwargs = dict((str(key), value) for key, value in spell['kwargs'].items())
+        current_spell = spells.Spell(board.player, getattr(spells, spell['target']), getattr(spells, spell['effect']), **kwargs)
+
+    return game, current_spell
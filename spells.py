@@ -1,6 +1,8 @@
 import libtcodpy as libtcod
 import game_piece
-import random
+
+#How far away casting a spell wakes dormant actors
+SPELL_NOISE_RADIUS = 32
 
 class Spell(object):
     """represents a spell made up of a caster, target or targets and effect"""
@@ -11,22 +13,24 @@ class Spell(object):
         self.kwargs = kwargs
 
     def cast(self):
+        self.caster.board.game.make_noise(self.caster.x, self.caster.y, SPELL_NOISE_RADIUS)
         targets = self.target_function(self.caster, self.kwargs)
         for target in targets:
             self.effect_function(target, self.kwargs)
 
 def random_spell(caster):
-    target = random_target()
-    effect = random_effect()
+    rng = caster.board.random
+    target = random_target(rng)
+    effect = random_effect(rng)
     return Spell(caster, target, effect)
 
-def random_target():
+def random_target(rng):
     target_functions = [zap_target, random_adjacent_target, burst_target, self_target]
-    return random.choice(target_functions)
+    return rng.choice(target_functions)
 
-def random_effect():
+def random_effect(rng):
     effect_functions = [hurt, freeze, growth]
-    return random.choice(effect_functions)
+    return rng.choice(effect_functions)
 
 def zap_target(caster, kwargs):
     board = caster.board
@@ -65,7 +69,7 @@ def random_adjacent_target(caster, kwargs):
                     targets.append(piece)
 
     #Shuffle the list of posible targets and select the first one
-    random.shuffle(targets)
+    board.random.shuffle(targets)
     return [targets[0]]
 
 def burst_target(caster, kwargs):
@@ -105,6 +109,7 @@ def growth(target, kwargs):
         target.sprite = game_piece.Sprite('#', libtcod.green)
         target.blocks_passage = True
         target.blocks_light = True
+        target.board.refresh_cell(target.x, target.y)
         fighter = game_piece.Fighter(hp=1, power=0, death_function=game_piece.wall_destruction)
         fighter.owner = target
         target.fighter = fighter
@@ -0,0 +1,108 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy
+import floor_cache
+import game_piece
+import savegame
+import spells
+from dungeon import Board
+from headless import Simulation, NullBackend
+
+#Every test plays the same seeded games, so a failure can be replayed with the same seed
+SEEDS = [1, 2, 3]
+SCRIPT = ['right', 'right', 'down', 'down_right', 'wait', 'zap', 'left', 'up', 'cast', 'up_left', 'down', 'wait'] * 4
+
+def piece_summary(piece):
+    return (piece.kind, piece.name, piece.x, piece.y, piece.fighter and (piece.fighter.hp, piece.fighter.death_function))
+
+def game_state(simulation):
+    #Everything that should come out the same when two games are played the same way
+    board = simulation.board
+    pieces = [piece_summary(piece) for piece in board.pieces]
+    return (board.depth, board.game.game_state, board.game.scheduler.time, pieces, board.map.tile_ids.tolist(),
+            board.fov.explored.tolist(), list(simulation.message_system.buffer))
+
+class SaveTest(unittest.TestCase):
+    """A saved game carries on exactly as the game it was saved from would have"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_then_act(self):
+        for seed in SEEDS:
+            played = Simulation(seed, backend=NullBackend())
+            played.run(SCRIPT[:len(SCRIPT) // 2])
+            path = os.path.join(self.directory, 'game%d.sav' % seed)
+            played.save(path)
+
+            loaded = Simulation(backend=NullBackend(), load_path=path)
+            self.assertEqual(game_state(loaded), game_state(played))
+
+            played.run(SCRIPT[len(SCRIPT) // 2:])
+            loaded.run(SCRIPT[len(SCRIPT) // 2:])
+            self.assertEqual(game_state(loaded), game_state(played))
+
+    def test_grown_corpse_dies_like_a_wall(self):
+        simulation = Simulation(3, backend=NullBackend())
+        index = grow_corpse(simulation.board)
+        path = os.path.join(self.directory, 'tree.sav')
+        simulation.save(path)
+
+        game, current_spell = savegame.load(path)
+        tree = game.board.generated_pieces[index]
+        self.assertEqual(tree.fighter.death_function, game_piece.wall_destruction)
+
+class CarveTest(unittest.TestCase):
+    """A floor carved a chunk at a time, in any order, comes out the same as one carved all at once"""
+    def test_lazy_carve(self):
+        for seed in SEEDS:
+            #generate only plans the floor, generate_any would carve it all to check it
+            whole = Board(160, 82, seed)
+            whole.map.generate()
+            whole.map.carve_all()
+
+            lazy = Board(160, 82, seed)
+            lazy.map.generate()
+            self.assertFalse(lazy.map.carved.any())
+            chunks = [(chunk_x, chunk_y) for chunk_x in range(lazy.map.chunks_x) for chunk_y in range(lazy.map.chunks_y)]
+            random.Random(seed).shuffle(chunks)
+            for chunk_x, chunk_y in chunks:
+                if not lazy.map.carved[chunk_x, chunk_y]:
+                    lazy.map.carve_chunk(chunk_x, chunk_y)
+
+            self.assertTrue(lazy.map.carved.all())
+            self.assertTrue(numpy.array_equal(lazy.map.tile_ids, whole.map.tile_ids))
+            self.assertTrue(numpy.array_equal(lazy.map.blocks_passage, whole.map.blocks_passage))
+            self.assertTrue(numpy.array_equal(lazy.map.blocks_light, whole.map.blocks_light))
+
+class JournalTest(unittest.TestCase):
+    """A floor the player left comes back from its FloorJournal as it was left"""
+    def test_restore(self):
+        simulation = Simulation(3, backend=NullBackend())
+        board = simulation.board
+        index = grow_corpse(board)
+        before = [piece_summary(piece) for piece in board.generated_pieces]
+        tile_ids = board.map.tile_ids.copy()
+
+        journal = floor_cache.journal_floor(floor_cache.VisitedFloor(board))
+        journal.restore(board, game_piece.DOWN_STAIRS)
+
+        after = [piece_summary(piece) for piece in board.generated_pieces]
+        self.assertEqual(after, before)
+        self.assertTrue(numpy.array_equal(board.map.tile_ids, tile_ids))
+        self.assertEqual(board.generated_pieces[index].fighter.death_function, game_piece.wall_destruction)
+
+def grow_corpse(board):
+    #Kill the first orc and grow its corpse into a tree, returns where it is in generated_pieces
+    orc = [piece for piece in board.generated_pieces if piece.kind == 'orc'][0]
+    orc.fighter.take_damage(orc.fighter.hp)
+    spells.growth(orc, {})
+    return board.generated_pieces.index(orc)
+
+if __name__ == '__main__':
+    unittest.main()